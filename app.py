@@ -1,63 +1,373 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import Flask, Response, g, render_template, request, jsonify, session, redirect, url_for, stream_with_context
 from functools import wraps
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
+from collections import OrderedDict, deque
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
+import asyncio
+import time
+import random
 from datetime import datetime, timedelta
-import pandas as pd
+import openpyxl
+import csv
 import io
 import os
+import fcntl
+import shutil
+import tempfile
+import uuid
+import hashlib
+import re
+import json
+import sqlite3
+import unicodedata
+import contextlib
+import contextvars
+import inspect
+import logging
+import logging.handlers
+import queue
+import atexit
+from urllib.parse import urlsplit
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-this-in-production'
 app.permanent_session_lifetime = timedelta(hours=8)
 
-# In-memory token storage
-tokens_storage = {}  # {user_id: {ministry_id: {access_token, refresh_token, expires_at}}}
-
-# Ministries configuration with SSO URLs
-ministries = [
-    {
-        "id": 1,
-        "name": "Bộ Y tế",
-        "url": "https://quantri-dvc.moh.gov.vn",
-        "sso_url": "https://sso-dvc.moh.gov.vn"
-    },
-    {
-        "id": 2,
-        "name": "Bộ Giáo dục và Đào tạo",
-        "url": "https://quantridvc.moet.gov.vn/",
-        "sso_url": "https://ssodvc.moet.gov.vn"
-    },
-    {
-        "id": 3,
-        "name": "Bộ Nội vụ",
-        "url": "https://quantri-dvc.moha.gov.vn/",
-        "sso_url": "https://sso-dvc.moha.gov.vn"
-    },
-    {
-        "id": 4,
-        "name": "Bộ Khoa học Công nghệ",
-        "url": "https://quantri.mst.gov.vn/vi/",
-        "sso_url": "https://ssodichvucong.mst.gov.vn"
-    },
-    {
-        "id": 5,
-        "name": "Bộ Xây dựng",
-        "url": "https://quantri.moc.gov.vn/",
-        "sso_url": "https://sso-motcua.moc.gov.vn"
-    },
-    {
-        "id": 6,
-        "name": "Bộ Nông nghiệp và môi trường",
-        "url": "https://taikhoannguoidung-dvcnnmt.mae.gov.vn",
-        "sso_url": "https://xacthuc-dvcnnmt.mae.gov.vn"
-    },
-    {
-        "id": 7,
-        "name": "Bộ Công Thương",
-        "url": "https://quantri-tthc.moit.gov.vn",
-        "sso_url": "https://sso-tthc.moit.gov.vn"
-    },
-]
+# Timeout (giây) cho request lấy token SSO của từng Bộ
+SSO_TIMEOUT = 10
+# Deadline chung (giây) khi tra cứu tài khoản trên tất cả các Bộ
+LOOKUP_DEADLINE = float(os.environ.get('LOOKUP_DEADLINE', 12))
+# Refresh token trước khi hết hạn bao lâu (giây)
+TOKEN_REFRESH_MARGIN = timedelta(seconds=int(os.environ.get('TOKEN_REFRESH_MARGIN', 120)))
+# Chu kỳ (giây) kiểm tra và refresh token nền khi đang có job import chạy
+TOKEN_REFRESH_INTERVAL = int(os.environ.get('TOKEN_REFRESH_INTERVAL', 30))
+# Nơi lưu token: 'memory://' (mỗi process một bản), 'sqlite:///duong/dan/tokens.db' hoặc 'redis://host:6379/0'
+# (sqlite/redis dùng chung giữa các worker gunicorn và giữ được token khi restart)
+TOKEN_STORE_URL = os.environ.get('TOKEN_STORE_URL', 'memory://')
+# Giữ token đã hết hạn thêm bao lâu (khi SSO không trả refresh_expires_in) trước khi xóa
+TOKEN_EVICT_GRACE = timedelta(hours=int(os.environ.get('TOKEN_EVICT_GRACE_HOURS', 8)))
+# Chu kỳ (giây) dọn token hết hạn khỏi store
+TOKEN_EVICT_INTERVAL = int(os.environ.get('TOKEN_EVICT_INTERVAL', 300))
+# Cache kết quả tra cứu tài khoản: thời gian sống (giây) và số key tối đa
+LOOKUP_CACHE_TTL = int(os.environ.get('LOOKUP_CACHE_TTL', 30))
+LOOKUP_CACHE_SIZE = int(os.environ.get('LOOKUP_CACHE_SIZE', 1024))
+# Tra cứu hàng loạt: số request song song mỗi Bộ, số bản ghi mỗi trang, số trang tối đa, số từ khóa tối đa
+BULK_LOOKUP_CONCURRENCY = int(os.environ.get('BULK_LOOKUP_CONCURRENCY', 4))
+BULK_LOOKUP_PAGE_SIZE = int(os.environ.get('BULK_LOOKUP_PAGE_SIZE', 50))
+BULK_LOOKUP_MAX_PAGES = int(os.environ.get('BULK_LOOKUP_MAX_PAGES', 20))
+BULK_LOOKUP_MAX_KEYWORDS = int(os.environ.get('BULK_LOOKUP_MAX_KEYWORDS', 2000))
+# Số luồng tối đa gọi song song tới các Bộ cho thao tác tương tác (đăng nhập, tra cứu)
+MINISTRY_MAX_WORKERS = int(os.environ.get('MINISTRY_MAX_WORKERS', 16))
+# Số luồng cho việc nền (tải cây agency, lưu token của các Bộ đăng nhập sau), tách khỏi đăng nhập / tra cứu
+BACKGROUND_MAX_WORKERS = int(os.environ.get('BACKGROUND_MAX_WORKERS', 4))
+# Thời gian tối đa (giây) một lời gọi đăng nhập / tra cứu được xếp hàng chờ thread; hạn chờ của từng Bộ
+# (SSO_TIMEOUT, LOOKUP_DEADLINE) chỉ tính từ lúc lời gọi bắt đầu chạy
+MINISTRY_QUEUE_TIMEOUT = int(os.environ.get('MINISTRY_QUEUE_TIMEOUT', 30))
+# Chế độ đăng nhập: 'race' (gửi song song, Bộ nào thành công trước thì dùng) hoặc 'sequential'
+LOGIN_MODE = os.environ.get('LOGIN_MODE', 'race')
+# Bỏ qua (không lưu token) các Bộ về sau khi đã có Bộ đăng nhập thành công
+LOGIN_CANCEL_LOSERS = os.environ.get('LOGIN_CANCEL_LOSERS', '0') == '1'
+
+# Kích thước connection pool cho mỗi host của một Bộ (nên >= số request song song tới Bộ đó)
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 32))
+# Số lần retry tự động khi lỗi kết nối / 429, 502-504 (chỉ áp dụng cho GET/PUT),
+# có thể ghi đè bằng 'max_retries' trong ministries
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 2))
+# Hệ số backoff (giây) giữa các lần retry: ngẫu nhiên trong [0, factor * 2^n]
+HTTP_BACKOFF_FACTOR = float(os.environ.get('HTTP_BACKOFF_FACTOR', 0.5))
+# Giới hạn tốc độ request tới mỗi Bộ (request/giây, 0 = không giới hạn) và số request dồn tối đa,
+# có thể ghi đè bằng 'rate_limit' / 'rate_burst' trong ministries
+MINISTRY_RATE_LIMIT = float(os.environ.get('MINISTRY_RATE_LIMIT', 10))
+MINISTRY_RATE_BURST = int(os.environ.get('MINISTRY_RATE_BURST', 20))
+# Gọi API các Bộ trên một event loop riêng (httpx.AsyncClient, cần cài httpx) thay vì mỗi request một thread.
+# Chỉ đổi cách gọi ra ngoài: số request của người dùng phục vụ đồng thời do worker gunicorn quyết định
+# (Procfile: -k gthread --threads 32, mỗi request một thread); hai cơ chế dùng cùng nhau được
+ASYNC_BACKEND = os.environ.get('ASYNC_BACKEND', '0') == '1'
+# Số kết nối tối đa tới mỗi Bộ khi dùng ASYNC_BACKEND
+ASYNC_MAX_CONNECTIONS = int(os.environ.get('ASYNC_MAX_CONNECTIONS', 100))
+
+# Thu thập metrics (độ trễ, lỗi, request đang chạy) cho /metrics; tắt thì gần như không tốn chi phí
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+# Token bảo vệ /metrics (header Authorization: Bearer <token>), để trống thì không yêu cầu
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+# Các mốc (giây) của histogram độ trễ
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Circuit breaker theo Bộ: số lỗi liên tiếp (timeout, lỗi kết nối, 5xx) để ngắt, thời gian (giây) ngắt trước khi thử lại
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_TIMEOUT = int(os.environ.get('CIRCUIT_RESET_TIMEOUT', 30))
+# Timeout thích ứng (chỉ cho GET): p99 độ trễ gần đây của cùng endpoint trên Bộ nhân hệ số, không nhỏ hơn
+# mức tối thiểu (giây) và không vượt timeout cấu hình của lời gọi; cần đủ số mẫu mới áp dụng
+ADAPTIVE_TIMEOUT_FACTOR = float(os.environ.get('ADAPTIVE_TIMEOUT_FACTOR', 4))
+ADAPTIVE_TIMEOUT_MIN = float(os.environ.get('ADAPTIVE_TIMEOUT_MIN', 5))
+ADAPTIVE_TIMEOUT_SAMPLES = int(os.environ.get('ADAPTIVE_TIMEOUT_SAMPLES', 20))
+
+# Số request tạo tài khoản song song tối đa tới mỗi Bộ (có thể ghi đè bằng 'max_concurrency' trong ministries)
+IMPORT_MINISTRY_CONCURRENCY = int(os.environ.get('IMPORT_MINISTRY_CONCURRENCY', 4))
+# Tổng số request tạo tài khoản song song tối đa trên tất cả các Bộ
+IMPORT_GLOBAL_CONCURRENCY = int(os.environ.get('IMPORT_GLOBAL_CONCURRENCY', 16))
+# Số worker của mỗi bước pipeline import trên mỗi Bộ; giới hạn request tới Bộ do slot của Bộ đảm nhận, không phụ thuộc số này
+IMPORT_STAGE_WORKERS = int(os.environ.get('IMPORT_STAGE_WORKERS', 4))
+# Số ô (dòng, Bộ) tối đa đang chờ ở mỗi bước của pipeline import (resolve agency, tạo tài khoản,
+# cập nhật quá trình công tác) của mỗi Bộ; đầy thì bước trước dừng lại chờ, tới tận bước đọc file
+IMPORT_STAGE_QUEUE_SIZE = int(os.environ.get('IMPORT_STAGE_QUEUE_SIZE', 64))
+# Chế độ skip_existing / update_existing: số dòng mỗi lần tra cứu tài khoản đã tồn tại (đọc file theo từng đợt,
+# không nạp cả file vào bộ nhớ)
+IMPORT_EXISTING_CHUNK_ROWS = int(os.environ.get('IMPORT_EXISTING_CHUNK_ROWS', 200))
+# Trang theo dõi job import qua stream NDJSON thay vì polling. Chỉ bật khi gunicorn chạy worker hỗ trợ
+# kết nối dài (-k gthread như Procfile, hoặc gevent); worker sync bị chiếm suốt thời gian stream và bị kill
+# khi quá --timeout. Với gthread mỗi stream đang mở giữ một trong --threads thread của worker
+IMPORT_STREAM_ENABLED = os.environ.get('IMPORT_STREAM_ENABLED', '0') == '1'
+# Khoảng thời gian (giây) tối đa giữa hai dòng NDJSON khi stream job import
+IMPORT_STREAM_HEARTBEAT = int(os.environ.get('IMPORT_STREAM_HEARTBEAT', 15))
+# Một kết nối stream job import kéo dài tối đa bao lâu (giây); hết thời gian client kết nối lại với `since`
+IMPORT_STREAM_MAX_SECONDS = int(os.environ.get('IMPORT_STREAM_MAX_SECONDS', 20))
+# Thời gian ước lượng (giây) để xử lý một dòng trên một Bộ, dùng khi kiểm tra token trước import
+IMPORT_ESTIMATED_SECONDS_PER_ROW = float(os.environ.get('IMPORT_ESTIMATED_SECONDS_PER_ROW', 3))
+# Kiểm tra trước import (chạy nền): số request tra cứu agency song song (executor riêng, không chiếm thread của
+# đăng nhập / tra cứu), số cặp (Bộ, agency) tối đa được tra cứu và thời gian chờ tối đa (giây) cho bước tra cứu agency
+PREFLIGHT_AGENCY_CONCURRENCY = int(os.environ.get('PREFLIGHT_AGENCY_CONCURRENCY', 4))
+PREFLIGHT_MAX_AGENCY_LOOKUPS = int(os.environ.get('PREFLIGHT_MAX_AGENCY_LOOKUPS', 500))
+PREFLIGHT_AGENCY_TIMEOUT = int(os.environ.get('PREFLIGHT_AGENCY_TIMEOUT', 60))
+# Thời gian giữ kết quả job import sau khi hoàn tất
+IMPORT_JOB_TTL = timedelta(hours=int(os.environ.get('IMPORT_JOB_TTL_HOURS', 24)))
+# Thư mục nhật ký (jsonl, ghi nối tiếp) kết quả từng ô (dòng, Bộ) của job import, dùng để tiếp tục job bị gián đoạn
+IMPORT_JOURNAL_DIR = os.environ.get('IMPORT_JOURNAL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'import-journal'))
+# Thư mục trạng thái job tra cứu hàng loạt / kiểm tra trước import, dùng chung giữa các worker gunicorn
+# (file bị khóa khi job đang chạy, chứa kết quả khi job xong)
+JOB_STATE_DIR = os.environ.get('JOB_STATE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'jobs'))
+
+# Cache tra cứu agency (tree-view): thời gian sống (giây) khi tìm thấy / không tìm thấy, số key tối đa
+AGENCY_CACHE_TTL = int(os.environ.get('AGENCY_CACHE_TTL', 600))
+AGENCY_CACHE_NEGATIVE_TTL = int(os.environ.get('AGENCY_CACHE_NEGATIVE_TTL', 60))
+AGENCY_CACHE_SIZE = int(os.environ.get('AGENCY_CACHE_SIZE', 2048))
+
+# Tải toàn bộ cây agency của từng Bộ về bộ nhớ để tra cứu cục bộ thay vì gọi API tìm kiếm
+AGENCY_INDEX_ENABLED = os.environ.get('AGENCY_INDEX_ENABLED', '0') == '1'
+# File cấu hình các Bộ: URL, API, chức vụ; tùy chọn theo Bộ: max_concurrency, max_retries, rate_limit, rate_burst
+MINISTRIES_CONFIG = os.environ.get('MINISTRIES_CONFIG', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ministries.json'))
+# Thư mục lưu cây agency đã tải để worker khởi động là có sẵn
+AGENCY_INDEX_DIR = os.environ.get('AGENCY_INDEX_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'agency'))
+# Chu kỳ (giây) tải lại cây agency
+AGENCY_INDEX_REFRESH = int(os.environ.get('AGENCY_INDEX_REFRESH', 6 * 3600))
+# Số agency mỗi trang khi tải toàn bộ cây
+AGENCY_INDEX_PAGE_SIZE = int(os.environ.get('AGENCY_INDEX_PAGE_SIZE', 1000))
+# Thời gian (giây) chờ trước khi tự tải lại cây agency sau một lần tải lỗi hoặc rỗng
+AGENCY_INDEX_RETRY_AFTER = int(os.environ.get('AGENCY_INDEX_RETRY_AFTER', 300))
+
+# Logging: mức log, định dạng ('json' hoặc 'text'), tỉ lệ lấy mẫu các log theo từng dòng / từng Bộ
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 0.1))
+# Request có header X-Debug bằng khóa này thì ghi cả log DEBUG (dump payload) cho riêng request đó
+LOG_DEBUG_KEY = os.environ.get('LOG_DEBUG_KEY', '')
+LOG_LEVEL_NO = getattr(logging, LOG_LEVEL, logging.INFO)
+
+# request_id và cờ debug của request hiện tại (truyền sang worker thread qua contextvars)
+log_context = contextvars.ContextVar('log_context', default={'request_id': None, 'debug': False})
+
+LOG_REDACT_KEYS = ('token', 'password', 'authorization', 'secret')
+LOG_REDACT_PATTERNS = (
+    (re.compile(r'(?i)(bearer\s+)[\w.~+/=-]+'), r'\1***'),
+    (re.compile(r'(?i)(["\']?[\w-]*(?:token|password|secret)["\']?\s*[:=]\s*["\']?)[^"\'\s,&}]+'), r'\1***'),
+)
+LOG_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'sampled'}
+
+def redact(value):
+    """Che token / mật khẩu trong chuỗi, dict, list trước khi ghi log"""
+    if isinstance(value, str):
+        for pattern, replacement in LOG_REDACT_PATTERNS:
+            value = pattern.sub(replacement, value)
+        return value
+    if isinstance(value, dict):
+        return {k: '***' if any(key in str(k).lower() for key in LOG_REDACT_KEYS) else redact(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    return value
+
+class LogContextFilter(logging.Filter):
+    """Gắn request_id; bỏ log dưới LOG_LEVEL trừ request đang debug; lấy mẫu log có extra sampled=True"""
+
+    def filter(self, record):
+        context = log_context.get()
+        record.request_id = context['request_id']
+        if record.levelno < LOG_LEVEL_NO and not context['debug']:
+            return False
+        if getattr(record, 'sampled', False) and not context['debug'] and random.random() >= LOG_SAMPLE_RATE:
+            return False
+        return True
+
+class StructuredFormatter(logging.Formatter):
+    """Một dòng JSON (hoặc text) mỗi log, các trường extra được ghi kèm và che thông tin nhạy cảm"""
+
+    def format(self, record):
+        fields = {k: v for k, v in vars(record).items() if k not in LOG_RECORD_ATTRS}
+        message = redact(record.getMessage())
+        if record.exc_info:
+            message += '\n' + redact(self.formatException(record.exc_info))
+
+        if LOG_FORMAT == 'text':
+            extra = ' '.join(f'{k}={redact(v)}' for k, v in fields.items() if k != 'request_id')
+            return f"{self.formatTime(record)} {record.levelname} [{fields.get('request_id') or '-'}] {message} {extra}".rstrip()
+        return json.dumps({
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': message,
+            **redact(fields)
+        }, ensure_ascii=False, default=str)
+
+def setup_logging():
+    """Logger ghi qua QueueHandler: thread gọi log chỉ đưa record vào queue, thread nền ghi ra stdout"""
+    logger = logging.getLogger('hethongtaptrung')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(StructuredFormatter())
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    logger.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return logger
+
+log = setup_logging()
+
+def log_debug_enabled():
+    """True nếu được ghi log DEBUG (LOG_LEVEL=DEBUG hoặc request hiện tại bật debug); kiểm tra trước khi dựng payload lớn"""
+    return LOG_LEVEL_NO <= logging.DEBUG or log_context.get()['debug']
+
+def submit_with_log_context(executor, fn, *args):
+    """executor.submit giữ request_id / cờ debug của request hiện tại trong worker thread"""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+# Thread pool cho các lời gọi song song tới các Bộ khi người dùng đang chờ (đăng nhập, tra cứu)
+ministry_executor = ThreadPoolExecutor(max_workers=MINISTRY_MAX_WORKERS, thread_name_prefix='ministry')
+# Thread pool cho việc nền, không chiếm thread của ministry_executor
+background_executor = ThreadPoolExecutor(max_workers=BACKGROUND_MAX_WORKERS, thread_name_prefix='background')
+# Thread pool riêng, nhỏ, cho bước tra cứu agency của kiểm tra trước import
+preflight_executor = ThreadPoolExecutor(max_workers=PREFLIGHT_AGENCY_CONCURRENCY, thread_name_prefix='preflight')
+# Worker pool xử lý job import: mỗi bước của pipeline trên mỗi Bộ một executor riêng; các bước của một Bộ
+# cùng chia slot của Bộ đó (max_concurrency) và tất cả cùng chia giới hạn tổng
+import_executors = {}  # {(bước, ministry_id): (ThreadPoolExecutor, BoundedSemaphore số ô chờ)}
+import_executors_lock = threading.Lock()
+import_ministry_slots = {}  # {ministry_id: BoundedSemaphore(max_concurrency)}
+import_global_slots = threading.BoundedSemaphore(IMPORT_GLOBAL_CONCURRENCY)
+
+# requests.Session dùng chung theo từng Bộ (keep-alive, tái sử dụng kết nối TLS)
+http_sessions = {}  # {ministry_id: requests.Session}
+http_sessions_lock = threading.Lock()
+# Tình trạng (circuit breaker, độ trễ) của từng Bộ
+ministry_health = {}  # {ministry_id: MinistryHealth}
+ministry_health_lock = threading.Lock()
+# Token bucket giới hạn tốc độ request của từng Bộ
+rate_limiters = {}  # {ministry_id: TokenBucket}
+rate_limiters_lock = threading.Lock()
+# Event loop gọi API các Bộ khi bật ASYNC_BACKEND (tạo lần đầu dùng trong mỗi process)
+async_backend = None  # AsyncBackend hoặc False nếu không dùng được
+async_backend_lock = threading.Lock()
+
+# Job import chạy nền
+import_jobs = {}  # {job_id: {user_id, status, results, completed, summary, ...}}
+import_jobs_lock = threading.Lock()
+import_jobs_changed = threading.Condition(import_jobs_lock)  # Báo cho các stream khi có dòng mới xong
+# Job tra cứu hàng loạt chạy nền (dùng chung import_jobs_lock và IMPORT_JOB_TTL)
+bulk_jobs = {}  # {job_id: {user_id, status, keywords, ministry_ids, matrix, ...}}
+# Job kiểm tra trước import chạy nền (cùng cơ chế với job tra cứu hàng loạt)
+preflight_jobs = {}  # {job_id: {user_id, status, checked_rows, report, ...}}
+
+token_refresher = None  # Thread refresh token nền
+
+
+def load_ministry_registry(path):
+    """Đọc cấu hình các Bộ một lần khi khởi động, dựng sẵn URL endpoint, header mẫu và bảng chức vụ.
+
+    Trả về (ministries, positions, default_position) với positions là {(ministry_id, chức vụ trong Excel): (position_id, position_name)}.
+    Bộ không có api_url chỉ dùng được SSO.
+    """
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+
+    default_position = (config['default_position']['id'], config['default_position']['name'])
+    registry = []
+    positions = {}
+    for entry in config['ministries']:
+        ministry = dict(entry)
+        api_url = (ministry.pop('api_url', None) or '').rstrip('/')
+        for role, position in ministry.pop('positions', {}).items():
+            positions[(ministry['id'], role)] = (position['id'], position['name'])
+        position = ministry.pop('default_position', None)
+        ministry['default_position'] = (position['id'], position['name']) if position else default_position
+
+        ministry['endpoints'] = {
+            'token': f"{ministry['sso_url'].rstrip('/')}/auth/realms/digo/protocol/openid-connect/token"
+        }
+        if api_url:
+            ministry['endpoints'].update({
+                'users': f'{api_url}/hu/user',
+                'create_user': f'{api_url}/hu/user/--fully',
+                'experience': f'{api_url}/hu/user/{{user_id}}/experience?checkAgencyEx=true',
+                'agency_tree': f'{api_url}/ba/agency/tree-view'
+            })
+
+        # Header mẫu theo loại request (chưa gồm Authorization)
+        ministry['headers'] = {
+            'sso': {
+                'Content-Type': 'application/x-www-form-urlencoded',
+                'Accept': 'application/json'
+            },
+            'lookup': {
+                'accept': '*/*',
+                'accept-language': 'vi,fr-FR;q=0.9,fr;q=0.8,en-US;q=0.7,en;q=0.6'
+            },
+            'agency': {
+                'Accept': 'application/json'
+            },
+            'write': {
+                'Accept': 'application/json, text/plain, */*',
+                'Accept-Language': 'vi',
+                'Content-Type': 'application/json',
+                'Origin': ministry['url'],
+                'Referer': ministry['url'] + '/',
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+            }
+        }
+        registry.append(ministry)
+
+    return registry, positions, default_position
+
+# Danh sách Bộ (thứ tự hiển thị) và tra cứu theo id
+ministries, ministry_positions, default_position = load_ministry_registry(MINISTRIES_CONFIG)
+ministries_by_id = {ministry['id']: ministry for ministry in ministries}
+
+
+@app.before_request
+def bind_log_context():
+    """Gắn request_id (header X-Request-ID hoặc sinh mới) và cờ debug cho log của request"""
+    request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex[:16]
+    debug = bool(LOG_DEBUG_KEY) and request.headers.get('X-Debug') == LOG_DEBUG_KEY
+    g.log_context_token = log_context.set({'request_id': request_id, 'debug': debug})
+
+@app.after_request
+def add_request_id_header(response):
+    response.headers['X-Request-ID'] = log_context.get()['request_id'] or ''
+    return response
+
+@app.teardown_request
+def reset_log_context(exc):
+    token = g.pop('log_context_token', None)
+    if token is not None:
+        try:
+            log_context.reset(token)
+        except ValueError:
+            # Response stream chạy xong ở context khác
+            pass
 
 # Login required decorator
 def login_required(f):
@@ -68,12 +378,986 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+class TTLCache:
+    """Cache TTL + LRU an toàn giữa các thread.
+
+    Kết quả None được cache riêng với negative_ttl. Các lần miss đồng thời cùng key
+    được gộp lại: chỉ một thread gọi loader, các thread khác chờ kết quả đó.
+    Loader raise exception hoặc cacheable(value) trả về False thì kết quả không được cache.
+    load_steps() là bản dạng step (xem ministry_steps) để dùng được cả trên event loop.
+    """
+
+    def __init__(self, maxsize, ttl, negative_ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._data = OrderedDict()  # {key: (expires_at, value)}
+        self._inflight = {}  # {key: Future}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'coalesced': 0, 'errors': 0, 'evictions': 0}
+
+    def get_or_load(self, key, loader, cacheable=None):
+        def load():
+            return loader()
+            yield  # generator không có bước nào
+
+        return run_steps(self.load_steps(key, load, cacheable))
+
+    def load_steps(self, key, loader_steps, cacheable=None):
+        """Như get_or_load, loader_steps() là generator step; lần miss bị gộp thì yield Future để chờ"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._data.move_to_end(key)
+                    self._stats['hits' if entry[1] is not None else 'negative_hits'] += 1
+                    return entry[1]
+                del self._data[key]
+
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+                self._stats['misses'] += 1
+            else:
+                self._stats['coalesced'] += 1
+
+        if not owner:
+            return (yield future)
+
+        try:
+            value = yield from loader_steps()
+        except BaseException as e:
+            with self._lock:
+                self._stats['errors'] += 1
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            ttl = self.ttl if value is not None else self.negative_ttl
+            if ttl > 0 and (cacheable is None or cacheable(value)):
+                self._data[key] = (time.monotonic() + ttl, value)
+                self._data.move_to_end(key)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+                    self._stats['evictions'] += 1
+            del self._inflight[key]
+        future.set_result(value)
+        return value
+
+    def invalidate(self, predicate):
+        """Xóa các key thỏa predicate(key, value), trả về số key đã xóa"""
+        with self._lock:
+            keys = [key for key, (_, value) in self._data.items() if predicate(key, value)]
+            for key in keys:
+                del self._data[key]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, size=len(self._data), inflight=len(self._inflight))
+        lookups = stats['hits'] + stats['negative_hits'] + stats['misses'] + stats['coalesced']
+        stats['hit_rate'] = round((stats['hits'] + stats['negative_hits'] + stats['coalesced']) / lookups, 4) if lookups else 0.0
+        return stats
+
+# Cache agency tree-view dùng chung: {(ministry_id, keyword): agency hoặc None}
+agency_cache = TTLCache(AGENCY_CACHE_SIZE, AGENCY_CACHE_TTL, AGENCY_CACHE_NEGATIVE_TTL)
+
+# Cache kết quả tra cứu tài khoản: {(user_id, ministry_id, keyword): kết quả theo Bộ}
+lookup_cache = TTLCache(LOOKUP_CACHE_SIZE, LOOKUP_CACHE_TTL)
+
+def invalidate_lookup_cache(ministry_id, account_data):
+    """Xóa các kết quả tra cứu trên một Bộ có thể khớp với tài khoản vừa tạo (của mọi user)"""
+    values = [(account_data.get(field) or '').casefold()
+              for field in ('username', 'fullname', 'email', 'phoneNumber')]
+    values = [value for value in values if value]
+
+    def matches(key, _):
+        keyword = key[2].casefold()
+        return key[1] == ministry_id and any(keyword in value for value in values)
+
+    return lookup_cache.invalidate(matches)
+
+# Gộp các lần refresh token đồng thời cho cùng (user_id, ministry_id); không cache kết quả
+token_refreshes = TTLCache(1, 0)
+
+def normalize_vietnamese(text):
+    """Chuẩn hóa tên tiếng Việt để so khớp: bỏ dấu, đ -> d, chữ thường, gộp khoảng trắng"""
+    text = unicodedata.normalize('NFD', text or '')
+    text = ''.join(ch for ch in text if unicodedata.category(ch) != 'Mn')
+    text = text.replace('đ', 'd').replace('Đ', 'D')
+    return ' '.join(text.casefold().split())
+
+class AmbiguousAgencyError(ValueError):
+    """Keyword khớp nhiều agency (trùng tên) nên không chọn được agency nào"""
+
+    def __init__(self, keyword, candidates):
+        self.keyword = keyword
+        self.candidates = candidates
+        super().__init__(f'Agency "{keyword}" trùng tên với {len(candidates)} đơn vị, vui lòng ghi rõ mã đơn vị hoặc agency cha')
+
+class AgencyIndex:
+    """Cây agency của một Bộ trong bộ nhớ, có index theo id, tên, mã, tên không dấu và liên kết cha"""
+
+    def __init__(self, ministry_id, agencies, loaded_at=None):
+        self.ministry_id = ministry_id
+        self.agencies = agencies
+        self.loaded_at = loaded_at or time.time()
+        self.by_id = {}
+        # Tên/mã có thể trùng giữa các đơn vị (vd. "Văn phòng") nên mỗi khoá giữ danh sách agency
+        self.by_name = {}
+        self.by_code = {}
+        self.by_normalized = {}
+        self.parent_ids = {}  # {agency_id: parent_id}
+
+        def add(index, key, agency):
+            bucket = index.setdefault(key, [])
+            if not bucket or bucket[-1] is not agency:
+                bucket.append(agency)
+
+        for agency in agencies:
+            agency_id = agency.get('id')
+            if not agency_id:
+                continue
+            self.by_id[agency_id] = agency
+            name = (agency.get('name') or '').strip()
+            code = (agency.get('code') or '').strip()
+            if name:
+                add(self.by_name, name, agency)
+                add(self.by_normalized, normalize_vietnamese(name), agency)
+            if code:
+                add(self.by_code, code, agency)
+                add(self.by_code, code.casefold(), agency)
+            parent = agency.get('parent')
+            parent_id = parent.get('id') if isinstance(parent, dict) else agency.get('parentId')
+            if parent_id:
+                self.parent_ids[agency_id] = parent_id
+
+    def is_within(self, agency_id, ancestor_id):
+        """agency_id có nằm trong cây con của ancestor_id (kể cả chính nó) không"""
+        seen = set()
+        while agency_id and agency_id not in seen:
+            if agency_id == ancestor_id:
+                return True
+            seen.add(agency_id)
+            agency_id = self.parent_ids.get(agency_id)
+        return False
+
+    def resolve(self, keyword, parent_id=None):
+        """Tìm agency theo tên, mã hoặc tên không dấu (trong cây con của parent_id nếu có);
+        None nếu không có, raise AmbiguousAgencyError nếu khớp nhiều agency"""
+        keyword = (keyword or '').strip()
+        if not keyword:
+            return None
+        for index, key in ((self.by_name, keyword), (self.by_code, keyword),
+                           (self.by_code, keyword.casefold()), (self.by_normalized, normalize_vietnamese(keyword))):
+            candidates = index.get(key, [])
+            if parent_id:
+                candidates = [agency for agency in candidates if self.is_within(agency['id'], parent_id)]
+            if len(candidates) > 1:
+                raise AmbiguousAgencyError(keyword, candidates)
+            if candidates:
+                return candidates[0]
+        return None
+
+    def is_stale(self):
+        return time.time() - self.loaded_at > AGENCY_INDEX_REFRESH
+
+    def path(self):
+        return os.path.join(AGENCY_INDEX_DIR, f'ministry_{self.ministry_id}.json')
+
+    def save(self):
+        """Ghi cây agency ra đĩa (ghi file tạm rồi đổi tên)"""
+        os.makedirs(AGENCY_INDEX_DIR, exist_ok=True)
+        tmp_path = self.path() + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'ministry_id': self.ministry_id, 'loaded_at': self.loaded_at, 'agencies': self.agencies}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path())
+
+    @classmethod
+    def load(cls, ministry_id):
+        """Đọc cây agency đã lưu trên đĩa, None nếu chưa có (hoặc cây rỗng)"""
+        path = os.path.join(AGENCY_INDEX_DIR, f'ministry_{ministry_id}.json')
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+            if not data['agencies']:
+                return None
+            return cls(ministry_id, data['agencies'], data.get('loaded_at'))
+        except (OSError, ValueError, KeyError):
+            return None
+
+# Cây agency đã tải của từng Bộ
+agency_indexes = {}  # {ministry_id: AgencyIndex}
+agency_index_loading = set()  # ministry_id đang được tải
+agency_index_failed_at = {}  # {ministry_id: time.monotonic() của lần tải lỗi gần nhất}
+agency_index_lock = threading.Lock()
+
+class MemoryTokenStore:
+    """Lưu token trong bộ nhớ của process"""
+
+    def __init__(self):
+        self._tokens = {}  # {user_id: {ministry_id: token_info}}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        now = datetime.now()
+        with self._lock:
+            return {ministry_id: dict(info) for ministry_id, info in self._tokens.get(user_id, {}).items()
+                    if info['evict_at'] > now}
+
+    def set(self, user_id, ministry_id, token_info):
+        with self._lock:
+            self._tokens.setdefault(user_id, {})[ministry_id] = dict(token_info)
+
+    def evict_expired(self):
+        now = datetime.now()
+        with self._lock:
+            for user_id in list(self._tokens):
+                user_tokens = self._tokens[user_id]
+                for ministry_id in [m for m, info in user_tokens.items() if info['evict_at'] <= now]:
+                    del user_tokens[ministry_id]
+                if not user_tokens:
+                    del self._tokens[user_id]
+
+class SQLiteTokenStore:
+    """Lưu token trong file SQLite (WAL), dùng chung giữa các worker trên cùng máy"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS tokens ('
+                ' user_id TEXT NOT NULL, ministry_id INTEGER NOT NULL,'
+                ' access_token TEXT, refresh_token TEXT,'
+                ' expires_at REAL NOT NULL, evict_at REAL NOT NULL,'
+                ' PRIMARY KEY (user_id, ministry_id))'
+            )
+
+    def _connect(self):
+        # Mỗi thread một connection; SQLite tự khóa file khi ghi giữa các process
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, user_id):
+        rows = self._connect().execute(
+            'SELECT ministry_id, access_token, refresh_token, expires_at, evict_at FROM tokens'
+            ' WHERE user_id = ? AND evict_at > ?',
+            (user_id, time.time())
+        ).fetchall()
+        return {ministry_id: {
+            'access_token': access_token,
+            'refresh_token': refresh_token,
+            'expires_at': datetime.fromtimestamp(expires_at),
+            'evict_at': datetime.fromtimestamp(evict_at)
+        } for ministry_id, access_token, refresh_token, expires_at, evict_at in rows}
+
+    def set(self, user_id, ministry_id, token_info):
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?, ?, ?)',
+                (user_id, ministry_id, token_info['access_token'], token_info.get('refresh_token'),
+                 token_info['expires_at'].timestamp(), token_info['evict_at'].timestamp())
+            )
+
+    def evict_expired(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM tokens WHERE evict_at <= ?', (time.time(),))
+
+class RedisTokenStore:
+    """Lưu token trong Redis: mỗi user một hash {ministry_id: JSON}.
+
+    Nhận client bất kỳ có hset/hgetall/hdel/expireat (redis-py hoặc bản thay thế cục bộ).
+    """
+
+    def __init__(self, client, prefix='igate:tokens:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, user_id):
+        now = datetime.now()
+        tokens, expired = {}, []
+        for field, raw in self.client.hgetall(self.prefix + user_id).items():
+            data = json.loads(raw)
+            info = {
+                'access_token': data['access_token'],
+                'refresh_token': data.get('refresh_token'),
+                'expires_at': datetime.fromtimestamp(data['expires_at']),
+                'evict_at': datetime.fromtimestamp(data['evict_at'])
+            }
+            if info['evict_at'] > now:
+                tokens[int(field)] = info
+            else:
+                expired.append(field)
+        if expired:
+            self.client.hdel(self.prefix + user_id, *expired)
+        return tokens
+
+    def set(self, user_id, ministry_id, token_info):
+        key = self.prefix + user_id
+        self.client.hset(key, str(ministry_id), json.dumps({
+            'access_token': token_info['access_token'],
+            'refresh_token': token_info.get('refresh_token'),
+            'expires_at': token_info['expires_at'].timestamp(),
+            'evict_at': token_info['evict_at'].timestamp()
+        }))
+        # Cả hash hết hạn theo token sống lâu nhất của user
+        evict_at = max(info['evict_at'] for info in self.get(user_id).values())
+        self.client.expireat(key, int(evict_at.timestamp()) + 1)
+
+    def evict_expired(self):
+        # Redis tự xóa key hết hạn; các Bộ hết hạn lẻ được xóa khi đọc
+        pass
+
+def create_token_store(url):
+    """Tạo token store từ TOKEN_STORE_URL"""
+    if url.startswith('sqlite:///'):
+        return SQLiteTokenStore(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        import redis
+        return RedisTokenStore(redis.Redis.from_url(url))
+    return MemoryTokenStore()
+
+token_store = create_token_store(TOKEN_STORE_URL)
+token_store_evicted_at = time.monotonic()
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Bộ đang bị ngắt (circuit mở): request bị từ chối ngay, không gửi đi"""
+
+class MinistryHealth:
+    """Circuit breaker và thống kê độ trễ của một Bộ, an toàn giữa các thread.
+
+    closed: gửi bình thường. Sau CIRCUIT_FAILURE_THRESHOLD lỗi liên tiếp chuyển sang open:
+    mọi request bị từ chối ngay trong CIRCUIT_RESET_TIMEOUT giây. Hết thời gian đó chuyển sang
+    half_open: chỉ cho một request thử; thành công thì đóng lại, lỗi thì mở tiếp.
+    Độ trễ được thống kê riêng theo endpoint (token, lookup, create...).
+    """
+
+    def __init__(self, window=200):
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.window = window
+        self.latencies = {}  # {endpoint: deque độ trễ gần đây}
+        self._lock = threading.Lock()
+        self._stats = {'success': 0, 'failure': 0, 'rejected': 0, 'opened': 0}
+
+    def before_request(self):
+        """Raise CircuitOpenError nếu request không được gửi"""
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= CIRCUIT_RESET_TIMEOUT:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self.probing:
+                self.probing = True
+                return
+            if self.state != 'closed':
+                self._stats['rejected'] += 1
+                retry_in = max(0, int(CIRCUIT_RESET_TIMEOUT - (time.monotonic() - self.opened_at)))
+                raise CircuitOpenError(f'Bộ tạm ngắt do lỗi liên tiếp, thử lại sau {retry_in}s')
+
+    def record_success(self, latency, endpoint='other'):
+        with self._lock:
+            self.latencies.setdefault(endpoint, deque(maxlen=self.window)).append(latency)
+            self.failures = 0
+            self.state = 'closed'
+            self.probing = False
+            self._stats['success'] += 1
+
+    def record_cancelled(self):
+        """Request bị hủy trước khi có kết quả: không tính là lỗi, chỉ nhả lượt thử của half_open"""
+        with self._lock:
+            self.probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._stats['failure'] += 1
+            if self.state == 'half_open' or self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+                if self.state != 'open':
+                    self._stats['opened'] += 1
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+    def percentile(self, q, endpoint):
+        with self._lock:
+            latencies = sorted(self.latencies.get(endpoint, ()))
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def timeout(self, default, endpoint):
+        """Timeout cho request tiếp theo tới endpoint: theo p99 độ trễ gần đây của endpoint đó, tối đa bằng timeout mặc định"""
+        if not isinstance(default, (int, float)) or len(self.latencies.get(endpoint, ())) < ADAPTIVE_TIMEOUT_SAMPLES:
+            return default
+        return min(default, max(ADAPTIVE_TIMEOUT_MIN, self.percentile(0.99, endpoint) * ADAPTIVE_TIMEOUT_FACTOR))
+
+    def stats(self):
+        with self._lock:
+            endpoints = list(self.latencies)
+        latency = {}
+        for endpoint in endpoints:
+            p50, p99 = self.percentile(0.5, endpoint), self.percentile(0.99, endpoint)
+            latency[endpoint] = {
+                'samples': len(self.latencies[endpoint]),
+                'p50': round(p50, 3) if p50 is not None else None,
+                'p99': round(p99, 3) if p99 is not None else None
+            }
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'latency': latency,
+                **self._stats
+            }
+
+class TokenBucket:
+    """Token bucket an toàn giữa các thread: `rate` request/giây, dồn tối đa `burst` request"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._stats = {'acquired': 0, 'throttled': 0, 'waited': 0.0}
+
+    def try_acquire(self, throttled=False):
+        """Lấy một token nếu có và trả về 0, ngược lại trả về số giây cần chờ trước khi thử lại"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self._stats['acquired'] += 1
+                self._stats['throttled'] += throttled
+                return 0
+            wait = (1 - self.tokens) / self.rate
+            self._stats['waited'] += wait
+            return wait
+
+    def acquire(self):
+        """Lấy một token, chờ nếu bucket đang cạn"""
+        throttled = False
+        while (wait := self.try_acquire(throttled)) > 0:
+            throttled = True
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Như acquire nhưng chờ bằng asyncio.sleep (không chặn event loop)"""
+        throttled = False
+        while (wait := self.try_acquire(throttled)) > 0:
+            throttled = True
+            await asyncio.sleep(wait)
+
+    def stats(self):
+        with self._lock:
+            return {'rate': self.rate, 'burst': self.burst, **self._stats, 'waited': round(self._stats['waited'], 3)}
+
+class Metrics:
+    """Counter, gauge và histogram theo nhãn, xuất ra định dạng text của Prometheus (an toàn giữa các thread).
+
+    Metrics tính riêng cho từng process (mỗi worker gunicorn một bộ).
+    """
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._metrics = {}  # {name: (type, help)}
+        self._values = {}  # {(name, labels): số hoặc [đếm theo bucket..., đếm +Inf, sum, count]}
+        self._lock = threading.Lock()
+
+    def describe(self, name, metric_type, help_text):
+        self._metrics[name] = (metric_type, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = [0] * (len(self.buckets) + 3)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[len(self.buckets)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, name, **labels):
+        """Đo thời gian khối lệnh vào histogram `name`"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def render(self, extra=()):
+        """Xuất toàn bộ metrics (và các dòng (name, labels, value) trong `extra`) theo định dạng Prometheus"""
+        with self._lock:
+            values = {key: list(v) if isinstance(v, list) else v for key, v in self._values.items()}
+        for name, labels, value in extra:
+            values[(name, tuple(sorted(labels.items())))] = value
+
+        def format_labels(labels, **more):
+            items = list(labels) + list(more.items())
+            if not items:
+                return ''
+            return '{' + ','.join(f'{k}="{str(v)}"' for k, v in items) + '}'
+
+        lines = []
+        for name in sorted({key[0] for key in values}):
+            metric_type, help_text = self._metrics.get(name, ('gauge', ''))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for (metric_name, labels), value in sorted(values.items(), key=lambda item: item[0]):
+                if metric_name != name:
+                    continue
+                if metric_type != 'histogram':
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), value[:-2]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels, le=bound)} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {round(value[-2], 6)}')
+                lines.append(f'{name}_count{format_labels(labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.describe('ministry_request_seconds', 'histogram', 'Độ trễ request tới API/SSO của các Bộ')
+metrics.describe('ministry_requests_total', 'counter', 'Số request tới các Bộ theo mã HTTP')
+metrics.describe('ministry_request_errors_total', 'counter', 'Số request lỗi (timeout, kết nối, 5xx, circuit mở)')
+metrics.describe('ministry_requests_in_flight', 'gauge', 'Số request tới các Bộ đang chờ phản hồi')
+metrics.describe('import_stage_seconds', 'histogram', 'Thời gian từng bước import (parse, agency_resolve, create, experience)')
+metrics.describe('import_cells_total', 'counter', 'Số ô (dòng, Bộ) import đã xử lý theo trạng thái')
+metrics.describe('cache_events_total', 'counter', 'Số hit/miss của các cache')
+metrics.describe('ministry_circuit_open', 'gauge', '1 nếu circuit breaker của Bộ đang mở')
+
+def timed_stage(stage):
+    """Decorator đo thời gian một bước import theo Bộ (tham số đầu tiên là ministry); metrics tắt thì giữ nguyên hàm.
+
+    Với hàm generator (dạng step), thời gian tính tới khi generator chạy xong.
+    """
+    def decorator(f):
+        if not METRICS_ENABLED:
+            return f
+
+        if inspect.isgeneratorfunction(f):
+            @wraps(f)
+            def steps_wrapper(ministry, *args, **kwargs):
+                with metrics.time('import_stage_seconds', stage=stage, ministry=ministry['id']):
+                    return (yield from f(ministry, *args, **kwargs))
+            return steps_wrapper
+
+        @wraps(f)
+        def wrapper(ministry, *args, **kwargs):
+            with metrics.time('import_stage_seconds', stage=stage, ministry=ministry['id']):
+                return f(ministry, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def stage_timer(stage, ministry_id):
+    """Context manager đo thời gian một bước import; metrics tắt thì không làm gì"""
+    if not METRICS_ENABLED:
+        return contextlib.nullcontext()
+    return metrics.time('import_stage_seconds', stage=stage, ministry=ministry_id)
+
+def metrics_endpoint(url):
+    """Tên endpoint (nhãn metrics) của URL gọi tới Bộ"""
+    path = urlsplit(url).path
+    if path.endswith('/openid-connect/token'):
+        return 'token'
+    if path.endswith('/--fully'):
+        return 'create'
+    if path.endswith('/experience'):
+        return 'experience'
+    if path.endswith('/tree-view'):
+        return 'agency'
+    if path.endswith('/hu/user'):
+        return 'lookup'
+    return 'other'
+
+class JitterRetry(Retry):
+    """Retry với backoff lũy thừa có jitter (full jitter) để các worker không retry cùng lúc"""
+
+    def get_backoff_time(self):
+        return random.uniform(0, super().get_backoff_time())
+
+def create_http_session(max_retries=HTTP_MAX_RETRIES):
+    """Tạo requests.Session với connection pool và retry adapter"""
+    retry = JitterRetry(
+        total=max_retries,
+        connect=max_retries,
+        read=max_retries,
+        status=max_retries,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        # 429 / 503 có header Retry-After thì chờ theo header
+        status_forcelist=(429, 502, 503, 504),
+        # POST tạo tài khoản / lấy token không được gửi lại khi server đã nhận request
+        allowed_methods=frozenset(['GET', 'PUT']),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+
+    http_session = requests.Session()
+    http_session.mount('https://', adapter)
+    http_session.mount('http://', adapter)
+    return http_session
+
+def get_http_session(ministry):
+    """Lấy Session dùng chung của một Bộ, tạo mới nếu chưa có (an toàn giữa các thread)"""
+    ministry_id = ministry['id']
+    http_session = http_sessions.get(ministry_id)
+    if http_session is None:
+        with http_sessions_lock:
+            http_session = http_sessions.get(ministry_id)
+            if http_session is None:
+                http_session = create_http_session(ministry.get('max_retries', HTTP_MAX_RETRIES))
+                http_sessions[ministry_id] = http_session
+    return http_session
+
+def get_ministry_health(ministry):
+    """Lấy MinistryHealth của một Bộ, tạo mới nếu chưa có"""
+    health = ministry_health.get(ministry['id'])
+    if health is None:
+        with ministry_health_lock:
+            health = ministry_health.setdefault(ministry['id'], MinistryHealth())
+    return health
+
+def get_rate_limiter(ministry):
+    """Lấy TokenBucket của một Bộ (None nếu không giới hạn tốc độ)"""
+    if ministry['id'] not in rate_limiters:
+        with rate_limiters_lock:
+            if ministry['id'] not in rate_limiters:
+                rate = ministry.get('rate_limit', MINISTRY_RATE_LIMIT)
+                burst = ministry.get('rate_burst', MINISTRY_RATE_BURST)
+                rate_limiters[ministry['id']] = TokenBucket(rate, burst) if rate > 0 else None
+    return rate_limiters[ministry['id']]
+
+def begin_ministry_request(ministry, method, url, kwargs):
+    """Kiểm tra circuit breaker và rút ngắn timeout (chỉ GET) trước khi gửi request; trả về (health, nhãn)"""
+    labels = {'ministry': ministry['id'], 'endpoint': metrics_endpoint(url), 'method': method}
+
+    health = get_ministry_health(ministry)
+    try:
+        health.before_request()
+    except CircuitOpenError:
+        if METRICS_ENABLED:
+            metrics.inc('ministry_request_errors_total', reason='circuit_open', **labels)
+        raise
+
+    # POST/PUT (tạo tài khoản, cập nhật quá trình công tác) không idempotent và chậm hơn hẳn GET:
+    # cắt ngắn có thể bỏ dở một thao tác mà Bộ vẫn đang xử lý, nên giữ nguyên timeout cấu hình
+    if 'timeout' in kwargs and method == 'GET':
+        kwargs['timeout'] = health.timeout(kwargs['timeout'], labels['endpoint'])
+    return health, labels
+
+def end_ministry_request(health, labels, started, response=None, error=None):
+    """Ghi nhận kết quả request vào circuit breaker và metrics"""
+    elapsed = time.monotonic() - started
+    if METRICS_ENABLED:
+        metrics.inc('ministry_requests_in_flight', -1, **labels)
+        metrics.observe('ministry_request_seconds', elapsed, **labels)
+
+    if error is not None:
+        if isinstance(error, asyncio.CancelledError):
+            health.record_cancelled()
+        else:
+            health.record_failure()
+        if METRICS_ENABLED:
+            metrics.inc('ministry_request_errors_total', reason=type(error).__name__, **labels)
+        return
+
+    if response.status_code >= 500:
+        health.record_failure()
+    else:
+        health.record_success(elapsed, labels['endpoint'])
+
+    if METRICS_ENABLED:
+        metrics.inc('ministry_requests_total', status=response.status_code, **labels)
+        if response.status_code >= 500:
+            metrics.inc('ministry_request_errors_total', reason=f'http_{response.status_code}', **labels)
+
+def ministry_request(ministry, method, url, **kwargs):
+    """Gửi HTTP request tới API/SSO của một Bộ qua Session dùng chung.
+
+    Bộ đang bị ngắt thì raise CircuitOpenError ngay (là một ConnectionError). Timeout truyền vào
+    là mức tối đa, được rút ngắn theo độ trễ thực tế của Bộ. Timeout, lỗi kết nối và 5xx tính là lỗi.
+    Request chờ token của rate limiter của Bộ trước khi gửi.
+    """
+    health, labels = begin_ministry_request(ministry, method, url, kwargs)
+    rate_limiter = get_rate_limiter(ministry)
+    if rate_limiter:
+        rate_limiter.acquire()
+
+    if METRICS_ENABLED:
+        metrics.inc('ministry_requests_in_flight', **labels)
+    started = time.monotonic()
+    try:
+        response = get_http_session(ministry).request(method, url, **kwargs)
+    except Exception as e:
+        end_ministry_request(health, labels, started, error=e)
+        raise
+
+    end_ministry_request(health, labels, started, response)
+    return response
+
+class AsyncBackend:
+    """Event loop chạy trên một thread riêng, gọi API các Bộ bằng httpx.AsyncClient (mỗi Bộ một connection pool).
+
+    Một thread phục vụ được hàng trăm request đồng thời tới các Bộ; các thread khác gửi coroutine
+    vào bằng submit() và nhận concurrent.futures.Future (giữ contextvars của thread gửi).
+    """
+
+    def __init__(self):
+        import httpx
+        self.httpx = httpx
+        self.transport_class = httpx.AsyncHTTPTransport
+        self.clients = {}  # {ministry_id: httpx.AsyncClient}, chỉ truy cập trên event loop
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True, name='ministry-async')
+        self.thread.start()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def client(self, ministry):
+        client = self.clients.get(ministry['id'])
+        if client is None:
+            limits = self.httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS, max_keepalive_connections=HTTP_POOL_MAXSIZE)
+            # Lỗi kết nối (request chưa tới server) được retry ở tầng transport cho mọi method
+            transport = self.transport_class(limits=limits, retries=ministry.get('max_retries', HTTP_MAX_RETRIES))
+            client = self.clients[ministry['id']] = self.httpx.AsyncClient(transport=transport)
+        return client
+
+    async def request(self, ministry, method, url, **kwargs):
+        """Gửi request, retry GET/PUT khi 429/5xx giống create_http_session; lỗi httpx được đổi sang lỗi requests"""
+        httpx = self.httpx
+        kwargs['follow_redirects'] = kwargs.pop('allow_redirects', True)
+        max_retries = ministry.get('max_retries', HTTP_MAX_RETRIES) if method in ('GET', 'PUT') else 0
+        for attempt in range(max_retries + 1):
+            try:
+                response = await self.client(ministry).request(method, url, **kwargs)
+            except httpx.ConnectTimeout as e:
+                raise requests.exceptions.ConnectTimeout(str(e)) from e
+            except httpx.TimeoutException as e:
+                if attempt < max_retries:
+                    await asyncio.sleep(random.uniform(0, HTTP_BACKOFF_FACTOR * 2 ** attempt))
+                    continue
+                raise requests.exceptions.ReadTimeout(str(e)) from e
+            except httpx.TransportError as e:
+                raise requests.exceptions.ConnectionError(str(e)) from e
+            except httpx.HTTPError as e:
+                raise requests.exceptions.RequestException(str(e)) from e
+
+            if response.status_code not in (429, 502, 503, 504) or attempt >= max_retries:
+                return response
+            retry_after = response.headers.get('Retry-After', '')
+            await asyncio.sleep(float(retry_after) if retry_after.isdigit() else random.uniform(0, HTTP_BACKOFF_FACTOR * 2 ** attempt))
+
+def get_async_backend():
+    """AsyncBackend của process nếu bật ASYNC_BACKEND; None nếu tắt hoặc chưa cài httpx"""
+    global async_backend
+    if not ASYNC_BACKEND:
+        return None
+    if async_backend is None:
+        with async_backend_lock:
+            if async_backend is None:
+                try:
+                    async_backend = AsyncBackend()
+                except ImportError:
+                    log.error('ASYNC_BACKEND=1 nhưng chưa cài httpx, dùng thread pool')
+                    async_backend = False
+    return async_backend or None
+
+async def ministry_request_async(ministry, method, url, **kwargs):
+    """Bản async của ministry_request, chạy trên event loop của AsyncBackend (circuit breaker, rate limit, metrics như nhau)"""
+    health, labels = begin_ministry_request(ministry, method, url, kwargs)
+    rate_limiter = get_rate_limiter(ministry)
+    if rate_limiter:
+        try:
+            await rate_limiter.acquire_async()
+        except BaseException:
+            # Bị hủy khi đang chờ rate limiter: chưa gửi gì, chỉ nhả lượt thử của half_open
+            health.record_cancelled()
+            raise
+
+    if METRICS_ENABLED:
+        metrics.inc('ministry_requests_in_flight', **labels)
+    started = time.monotonic()
+    try:
+        response = await get_async_backend().request(ministry, method, url, **kwargs)
+    except BaseException as e:
+        # Gồm cả CancelledError (bên gọi hủy hoặc hết hạn chờ): gauge in-flight và circuit breaker luôn được cập nhật
+        end_ministry_request(health, labels, started, error=e)
+        raise
+
+    end_ministry_request(health, labels, started, response)
+    return response
+
+class MinistryCall:
+    """Một HTTP request tới Bộ do hàm dạng step yield ra; driver gửi đi và trả response (hoặc raise) vào generator"""
+    __slots__ = ('ministry', 'method', 'url', 'kwargs')
+
+    def __init__(self, ministry, method, url, **kwargs):
+        self.ministry = ministry
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+
+class BlockingCall:
+    """I/O chặn (token store SQLite/Redis, đọc file...) do hàm dạng step yield ra: run_steps gọi trực tiếp,
+    run_steps_async chạy trong ministry_executor để không chặn event loop"""
+    __slots__ = ('fn', 'args')
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+def run_steps(steps):
+    """Chạy generator step trên thread hiện tại: MinistryCall gửi qua ministry_request, BlockingCall gọi trực tiếp,
+    Future thì chờ kết quả"""
+    value, error = None, None
+    while True:
+        try:
+            step = steps.throw(error) if error is not None else steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            if isinstance(step, Future):
+                value, error = step.result(), None
+            elif isinstance(step, BlockingCall):
+                value, error = step.fn(*step.args), None
+            else:
+                value, error = ministry_request(step.ministry, step.method, step.url, **step.kwargs), None
+        except BaseException as e:
+            value, error = None, e
+
+async def run_steps_async(steps):
+    """Như run_steps nhưng trên event loop: MinistryCall gửi qua ministry_request_async, BlockingCall chạy trong executor"""
+    loop = asyncio.get_running_loop()
+    value, error = None, None
+    while True:
+        try:
+            step = steps.throw(error) if error is not None else steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            if isinstance(step, Future):
+                value, error = await asyncio.wrap_future(step), None
+            elif isinstance(step, BlockingCall):
+                value, error = await loop.run_in_executor(ministry_executor, contextvars.copy_context().run, step.fn, *step.args), None
+            else:
+                value, error = await ministry_request_async(step.ministry, step.method, step.url, **step.kwargs), None
+        except BaseException as e:
+            value, error = None, e
+
+def ministry_steps(steps_fn):
+    """Decorator cho hàm gọi API Bộ viết dạng generator (yield MinistryCall / Future để lấy kết quả).
+
+    Hàm sau khi decorate chạy đồng bộ như trước; .run_async(...) là bản coroutine cho AsyncBackend,
+    .steps(...) trả về generator để hàm step khác gọi lồng bằng `yield from`.
+    """
+    @wraps(steps_fn)
+    def run(*args, **kwargs):
+        return run_steps(steps_fn(*args, **kwargs))
+
+    async def run_async(*args, **kwargs):
+        return await run_steps_async(steps_fn(*args, **kwargs))
+
+    run.steps = steps_fn
+    run.run_async = run_async
+    return run
+
+def submit_ministry_call(fn, *args):
+    """Chạy song song một hàm gọi API Bộ (đã decorate bằng ministry_steps), trả về concurrent.futures.Future.
+
+    Bật ASYNC_BACKEND thì chạy trên event loop, ngược lại trên ministry_executor. Future có thêm
+    `timing` = {submitted_at, started_at (None khi còn xếp hàng)} để iter_ministry_calls tính hạn chờ.
+    """
+    timing = {'submitted_at': time.monotonic(), 'started_at': None}
+    backend = get_async_backend()
+    if backend:
+        async def run_async():
+            timing['started_at'] = time.monotonic()
+            return await fn.run_async(*args)
+        future = backend.submit(run_async())
+    else:
+        def run():
+            timing['started_at'] = time.monotonic()
+            return fn(*args)
+        future = submit_with_log_context(ministry_executor, run)
+    future.timing = timing
+    return future
+
+def iter_ministry_calls(futures, timeout):
+    """Sinh (future, timed_out) theo thứ tự lời gọi nào xong trước (futures từ submit_ministry_call).
+
+    Hạn `timeout` giây của mỗi lời gọi tính từ lúc nó bắt đầu chạy, không tính thời gian xếp hàng
+    (tối đa MINISTRY_QUEUE_TIMEOUT giây). Lời gọi quá hạn bị hủy và sinh ra với timed_out=True.
+    timeout=None: chờ tất cả.
+    """
+    pending = set(futures)
+    while pending:
+        now = time.monotonic()
+        next_deadline = None
+        queued = False
+        for future in list(pending):
+            if future.done():
+                continue
+            timing = future.timing
+            if timing['started_at'] is None:
+                queued = True
+                deadline = timing['submitted_at'] + MINISTRY_QUEUE_TIMEOUT
+            elif timeout is None:
+                continue
+            else:
+                deadline = timing['started_at'] + timeout
+            if deadline <= now:
+                pending.discard(future)
+                future.cancel()
+                yield future, True
+            elif next_deadline is None or deadline < next_deadline:
+                next_deadline = deadline
+
+        if not pending:
+            break
+        wait_timeout = None if next_deadline is None else max(0, next_deadline - time.monotonic())
+        if queued:
+            # Lời gọi đang xếp hàng có thể bắt đầu bất cứ lúc nào (hạn của nó đổi theo): kiểm tra lại sớm
+            wait_timeout = 0.1 if wait_timeout is None else min(wait_timeout, 0.1)
+        done, _ = wait(pending, timeout=wait_timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.discard(future)
+            yield future, False
+
 # Login to ministry SSO
+@ministry_steps
 def login_ministry_sso(ministry, username, password):
     """Login to ministry SSO and get access token"""
-    sso_url = ministry['sso_url']
-    token_url = f"{sso_url}/auth/realms/digo/protocol/openid-connect/token"
-
     data = {
         'grant_type': 'password',
         'username': username,
@@ -81,13 +1365,9 @@ def login_ministry_sso(ministry, username, password):
         'client_id': 'web-onegate'
     }
 
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded',
-        'Accept': 'application/json'
-    }
-
     try:
-        response = requests.post(token_url, data=data, headers=headers, timeout=10, allow_redirects=False)
+        response = yield MinistryCall(ministry, 'POST', ministry['endpoints']['token'], data=data,
+                                      headers=ministry['headers']['sso'], timeout=SSO_TIMEOUT, allow_redirects=False)
 
         # Check content type before parsing JSON
         content_type = response.headers.get('content-type', '').lower()
@@ -97,38 +1377,200 @@ def login_ministry_sso(ministry, username, password):
             return {
                 'access_token': token_data.get('access_token'),
                 'refresh_token': token_data.get('refresh_token'),
-                'expires_in': token_data.get('expires_in', 3600)
+                'expires_in': token_data.get('expires_in', 3600),
+                'refresh_expires_in': token_data.get('refresh_expires_in')
             }
         else:
-            print(f"[{ministry['name']}] Status: {response.status_code}, Content-Type: {content_type}")
-            if response.text:
-                preview = response.text[:200]
-                print(f"[{ministry['name']}] Response preview: {preview}")
+            log.warning('Đăng nhập SSO thất bại', extra={'ministry': ministry['id'], 'status': response.status_code,
+                                                         'content_type': content_type, 'preview': response.text[:200]})
     except requests.exceptions.RequestException as e:
-        print(f"[{ministry['name']}] Request error: {e}")
-    except Exception as e:
-        print(f"[{ministry['name']}] Error: {e}")
+        log.warning('Lỗi kết nối SSO: %s', e, extra={'ministry': ministry['id']})
+    except Exception:
+        log.exception('Lỗi đăng nhập SSO', extra={'ministry': ministry['id']})
     return None
 
+@ministry_steps
+def refresh_ministry_token(ministry, refresh_token):
+    """Lấy access token mới từ SSO bằng refresh_token"""
+    data = {
+        'grant_type': 'refresh_token',
+        'refresh_token': refresh_token,
+        'client_id': 'web-onegate'
+    }
+
+    try:
+        response = yield MinistryCall(ministry, 'POST', ministry['endpoints']['token'], data=data,
+                                      headers=ministry['headers']['sso'], timeout=SSO_TIMEOUT, allow_redirects=False)
+        content_type = response.headers.get('content-type', '').lower()
+
+        if response.status_code == 200 and 'application/json' in content_type:
+            token_data = response.json()
+            return {
+                'access_token': token_data.get('access_token'),
+                'refresh_token': token_data.get('refresh_token') or refresh_token,
+                'expires_in': token_data.get('expires_in', 3600),
+                'refresh_expires_in': token_data.get('refresh_expires_in')
+            }
+        log.warning('Refresh token thất bại', extra={'ministry': ministry['id'], 'status': response.status_code})
+    except requests.exceptions.RequestException as e:
+        log.warning('Lỗi kết nối khi refresh token: %s', e, extra={'ministry': ministry['id']})
+    return None
+
+def login_all_ministries(username, password, ministry_list=None):
+    """Đăng nhập song song vào SSO của các Bộ.
+
+    Trả về {ministry_id: token_data hoặc None}. Mỗi Bộ có deadline riêng tính từ
+    lúc request bắt đầu chạy; hàm trả về khi Bộ chậm nhất xong hoặc hết deadline.
+    """
+    ministry_list = ministry_list if ministry_list is not None else ministries
+
+    futures = {submit_ministry_call(login_ministry_sso, ministry, username, password): ministry
+               for ministry in ministry_list}
+
+    token_results = {}
+    for future, timed_out in iter_ministry_calls(futures, SSO_TIMEOUT + 1):
+        ministry = futures[future]
+        if timed_out:
+            log.warning('SSO timeout', extra={'ministry': ministry['id']})
+            token_results[ministry['id']] = None
+        else:
+            token_results[ministry['id']] = future.result()
+    return token_results
+
+def login_first_success(username, password, cancel_losers=None):
+    """Gửi request đăng nhập tới tất cả các Bộ cùng lúc, trả về (ministry, token_data) thành công đầu tiên.
+
+    Token của các Bộ thành công sau vẫn được lưu qua save_token() khi request hoàn tất,
+    trừ khi cancel_losers=True. Trả về (None, None) nếu không Bộ nào thành công.
+    """
+    if cancel_losers is None:
+        cancel_losers = LOGIN_CANCEL_LOSERS
+
+    def keep_token(ministry):
+        def callback(future):
+            if future.cancelled():
+                return
+            try:
+                token_data = future.result()
+            except Exception:
+                return
+            if token_data:
+                # Callback có thể chạy trên event loop của AsyncBackend: ghi token store ở thread khác
+                background_executor.submit(save_token, username, ministry['id'], token_data)
+        return callback
+
+    futures = {}
+    for ministry in ministries:
+        future = submit_ministry_call(login_ministry_sso, ministry, username, password)
+        futures[future] = ministry
+
+    winner_future, winner, winner_token = None, None, None
+    for future, timed_out in iter_ministry_calls(futures, SSO_TIMEOUT + 1):
+        token_data = None if timed_out else future.result()
+        if token_data:
+            winner_future, winner, winner_token = future, futures[future], token_data
+            break
+
+    if winner:
+        save_token(username, winner['id'], winner_token)
+
+    for future, ministry in futures.items():
+        if future is winner_future:
+            continue
+        if cancel_losers:
+            future.cancel()
+        else:
+            future.add_done_callback(keep_token(ministry))
+
+    return winner, winner_token
+
 def save_token(user_id, ministry_id, token_data):
-    """Save token to in-memory storage"""
-    if user_id not in tokens_storage:
-        tokens_storage[user_id] = {}
+    """Save token to the configured token store"""
+    global token_store_evicted_at
 
     expires_at = datetime.now() + timedelta(seconds=token_data['expires_in'])
 
-    tokens_storage[user_id][ministry_id] = {
+    # Token được giữ tới khi refresh_token hết hạn (nếu biết), không thì thêm TOKEN_EVICT_GRACE
+    if token_data.get('refresh_expires_in'):
+        evict_at = max(expires_at, datetime.now() + timedelta(seconds=token_data['refresh_expires_in']))
+    else:
+        evict_at = expires_at + TOKEN_EVICT_GRACE
+
+    token_store.set(user_id, ministry_id, {
         'access_token': token_data['access_token'],
         'refresh_token': token_data.get('refresh_token'),
-        'expires_at': expires_at
-    }
+        'expires_at': expires_at,
+        'evict_at': evict_at
+    })
+
+    if time.monotonic() - token_store_evicted_at > TOKEN_EVICT_INTERVAL:
+        token_store_evicted_at = time.monotonic()
+        token_store.evict_expired()
 
 def get_user_tokens(user_id):
-    """Get all tokens for a user from in-memory storage"""
-    if user_id not in tokens_storage:
-        return {}
+    """Get all tokens for a user from the configured token store"""
+    return token_store.get(user_id)
+
+@ministry_steps
+def refresh_user_token(user_id, ministry):
+    """Refresh token của user cho một Bộ và lưu lại; bỏ qua nếu thread khác vừa refresh xong"""
+    token_info = (yield BlockingCall(get_user_tokens, user_id)).get(ministry['id'])
+    if not token_info or not token_info.get('refresh_token'):
+        return False
+    if token_info['expires_at'] - datetime.now() > TOKEN_REFRESH_MARGIN:
+        return True
+
+    token_data = yield from refresh_ministry_token.steps(ministry, token_info['refresh_token'])
+    if not token_data or not token_data['access_token']:
+        return False
+
+    yield BlockingCall(save_token, user_id, ministry['id'], token_data)
+    return True
+
+@ministry_steps
+def get_valid_token(user_id, ministry_id):
+    """Token của user cho một Bộ, tự refresh nếu sắp hết hạn; None nếu chưa có token.
+
+    Các lần refresh đồng thời cùng (user, Bộ) được gộp thành một request.
+    Token trả về vẫn có thể đã hết hạn nếu refresh thất bại.
+    """
+    token_info = (yield BlockingCall(get_user_tokens, user_id)).get(ministry_id)
+    if token_info is None:
+        return None
+    if token_info['expires_at'] - datetime.now() > TOKEN_REFRESH_MARGIN or not token_info.get('refresh_token'):
+        return token_info
+
+    ministry = ministries_by_id.get(ministry_id)
+    if ministry:
+        try:
+            yield from token_refreshes.load_steps((user_id, ministry_id), lambda: refresh_user_token.steps(user_id, ministry))
+        except Exception as e:
+            log.warning('Lỗi refresh token: %s', e, extra={'ministry': ministry_id})
+
+    return (yield BlockingCall(get_user_tokens, user_id)).get(ministry_id)
 
-    return tokens_storage[user_id]
+def run_token_refresher():
+    """Thread nền: refresh token của các user đang có job import chạy, để job không dừng giữa chừng"""
+    while True:
+        time.sleep(TOKEN_REFRESH_INTERVAL)
+        # Lỗi của một lượt (token store, lỗi bất ngờ khi refresh...) không được làm chết thread
+        try:
+            with import_jobs_lock:
+                active = {(job['user_id'], ministry_id)
+                          for job in import_jobs.values() if job['status'] != 'done'
+                          for ministry_id in job['ministry_ids']}
+            for user_id, ministry_id in active:
+                get_valid_token(user_id, ministry_id)
+        except Exception:
+            log.exception('Lỗi refresh token nền')
+
+def start_token_refresher():
+    """Khởi động thread refresh token nền (một lần cho mỗi process)"""
+    global token_refresher
+    with import_jobs_lock:
+        if token_refresher is None:
+            token_refresher = threading.Thread(target=run_token_refresher, daemon=True, name='token-refresher')
+            token_refresher.start()
 
 @app.route('/')
 def index():
@@ -139,7 +1581,7 @@ def index():
         'username': session.get('username', ''),
         'full_name': session.get('full_name', session.get('username', ''))
     }
-    return render_template('index.html', ministries=ministries, user=user)
+    return render_template('index.html', ministries=ministries, user=user, import_stream=IMPORT_STREAM_ENABLED)
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -151,14 +1593,19 @@ def login():
         login_success = False
         successful_ministry = None
 
-        for ministry in ministries:
-            token_data = login_ministry_sso(ministry, username, password)
-            if token_data:
-                login_success = True
-                successful_ministry = ministry
-                # Lưu token của Bộ này luôn
-                save_token(username, ministry['id'], token_data)
-                break
+        if LOGIN_MODE == 'race':
+            # Gửi song song, Bộ nào thành công trước thì dùng; token các Bộ khác lưu dần ở nền
+            successful_ministry, _ = login_first_success(username, password)
+            login_success = successful_ministry is not None
+        else:
+            for ministry in ministries:
+                token_data = login_ministry_sso(ministry, username, password)
+                if token_data:
+                    login_success = True
+                    successful_ministry = ministry
+                    # Lưu token của Bộ này luôn
+                    save_token(username, ministry['id'], token_data)
+                    break
 
         if login_success:
             session['user_id'] = username
@@ -191,9 +1638,10 @@ def sync_tokens():
         return jsonify({'error': 'Chưa có thông tin đăng nhập. Vui lòng đăng nhập lại.'})
 
     results = []
+    token_results = login_all_ministries(ministry_username, ministry_password)
 
     for ministry in ministries:
-        token_data = login_ministry_sso(ministry, ministry_username, ministry_password)
+        token_data = token_results.get(ministry['id'])
         if token_data:
             save_token(user_id, ministry['id'], token_data)
             results.append({
@@ -236,6 +1684,65 @@ def list_tokens():
 
     return jsonify({'tokens': token_list})
 
+@app.route('/cache-stats')
+@login_required
+def cache_stats():
+    """Thống kê hit/miss của các cache"""
+    return jsonify({'agency_tree': agency_cache.stats(), 'lookup': lookup_cache.stats()})
+
+@app.route('/metrics')
+def metrics_text():
+    """Metrics theo định dạng text của Prometheus (độ trễ / lỗi / request đang chạy tới các Bộ, các bước import)"""
+    if not METRICS_ENABLED:
+        return jsonify({'error': 'Metrics đang tắt (METRICS_ENABLED=0)'}), 404
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    extra = []
+    for cache_name, cache in (('agency_tree', agency_cache), ('lookup', lookup_cache)):
+        for event, value in cache.stats().items():
+            if isinstance(value, int) and event not in ('size', 'inflight'):
+                extra.append(('cache_events_total', {'cache': cache_name, 'event': event}, value))
+    for ministry in ministries:
+        extra.append(('ministry_circuit_open', {'ministry': ministry['id']},
+                      int(get_ministry_health(ministry).state != 'closed')))
+
+    return Response(metrics.render(extra), mimetype='text/plain; version=0.0.4')
+
+@app.route('/ministry-health')
+@login_required
+def ministry_health_stats():
+    """Trạng thái circuit breaker và độ trễ của từng Bộ"""
+    return jsonify({'ministries': [{
+        'ministry_id': ministry['id'],
+        'ministry_name': ministry['name'],
+        **get_ministry_health(ministry).stats(),
+        'rate_limit': get_rate_limiter(ministry).stats() if get_rate_limiter(ministry) else None
+    } for ministry in ministries]})
+
+@app.route('/agency-index/refresh', methods=['POST'])
+@login_required
+def refresh_agency_indexes():
+    """Tải lại cây agency của các Bộ mà user đang có token"""
+    futures = {}
+    for ministry in ministries:
+        token_info = get_valid_token(session['user_id'], ministry['id'])
+        if token_info and token_info['expires_at'] > datetime.now():
+            futures[ministry['id']] = submit_with_log_context(background_executor, refresh_agency_index, ministry, token_info['access_token'])
+
+    results = []
+    for ministry in ministries:
+        future = futures.get(ministry['id'])
+        index = future.result() if future else None
+        results.append({
+            'ministry_id': ministry['id'],
+            'ministry_name': ministry['name'],
+            'status': 'success' if index else ('failed' if future else 'no_token'),
+            'agency_count': len(index.agencies) if index else 0
+        })
+
+    return jsonify({'results': results})
+
 @app.route('/search', methods=['POST'])
 @login_required
 def search():
@@ -248,141 +1755,576 @@ def search():
     else:
         results = ministries
 
-    return jsonify({'results': results})
+    # Chỉ trả thông tin hiển thị; endpoints, headers, chức vụ mặc định là cấu hình nội bộ
+    return jsonify({'results': [{k: m[k] for k in ('id', 'name', 'url', 'sso_url')} for m in results]})
+
+@ministry_steps
+def lookup_on_ministry(ministry, keyword, user_id, all_pages=False, exact=False):
+    """Tra cứu tài khoản trên một Bộ, trả về kết quả theo Bộ (có cache ngắn hạn theo user).
+
+    all_pages=True: lấy đủ tất cả các trang thay vì chỉ 10 kết quả đầu.
+    exact=True: chỉ tìm tài khoản có username đúng bằng keyword (bỏ qua all_pages).
+    """
+    ministry_id = ministry['id']
+    ministry_name = ministry['name']
+
+    result = {
+        'ministry_id': ministry_id,
+        'ministry_name': ministry_name,
+        'status': 'pending',
+        'found': False,
+        'accounts': [],
+        'message': ''
+    }
+
+    # Kiểm tra token (tự refresh nếu sắp hết hạn)
+    token_info = yield from get_valid_token.steps(user_id, ministry_id)
+    if token_info is None:
+        result['status'] = 'no_token'
+        result['message'] = 'Chưa đồng bộ token'
+        return result
+
+    access_token = token_info['access_token']
+
+    # Kiểm tra token hết hạn
+    if token_info['expires_at'] < datetime.now():
+        result['status'] = 'token_expired'
+        result['message'] = 'Token đã hết hạn'
+        return result
+
+    # Các truy vấn giống nhau đang chạy được gộp; chỉ cache kết quả thành công
+    if exact:
+        query = query_exact_account
+    else:
+        query = query_all_ministry_accounts if all_pages else query_ministry_accounts
+    return (yield from lookup_cache.load_steps(
+        (user_id, ministry_id, keyword, all_pages, exact),
+        lambda: query.steps(ministry, keyword, access_token, dict(result)),
+        cacheable=lambda cached: cached['status'] == 'success'
+    ))
+
+@ministry_steps
+def query_all_ministry_accounts(ministry, keyword, access_token, result):
+    """Gọi API /hu/user lần lượt từng trang cho tới khi lấy đủ kết quả (tối đa BULK_LOOKUP_MAX_PAGES trang)"""
+    accounts = []
+    for page in range(BULK_LOOKUP_MAX_PAGES):
+        page_result = yield from query_ministry_accounts.steps(ministry, keyword, access_token, dict(result), page, BULK_LOOKUP_PAGE_SIZE)
+        if page_result['status'] != 'success':
+            return page_result
+
+        accounts.extend(page_result['accounts'])
+        total_pages = page_result.get('total_pages')
+        if len(page_result['accounts']) < BULK_LOOKUP_PAGE_SIZE or (total_pages is not None and page + 1 >= total_pages):
+            break
+
+    result.update(page_result)
+    result['accounts'] = accounts
+    result['found'] = len(accounts) > 0
+    result['message'] = f'Tìm thấy {len(accounts)} tài khoản' if accounts else 'Không tìm thấy tài khoản'
+    return result
+
+@ministry_steps
+def query_exact_account(ministry, username, access_token, result):
+    """Tìm tài khoản có username đúng bằng `username`: keyword của API khớp cả chuỗi con nên đọc từng trang
+    và dừng ngay ở tài khoản khớp chính xác đầu tiên (tối đa BULK_LOOKUP_MAX_PAGES trang)"""
+    for page in range(BULK_LOOKUP_MAX_PAGES):
+        page_result = yield from query_ministry_accounts.steps(ministry, username, access_token, dict(result), page, BULK_LOOKUP_PAGE_SIZE)
+        if page_result['status'] != 'success':
+            return page_result
+
+        match = next((account for account in page_result['accounts']
+                      if account_username(account).casefold() == username.casefold()), None)
+        total_pages = page_result.get('total_pages')
+        if (match is not None or len(page_result['accounts']) < BULK_LOOKUP_PAGE_SIZE
+                or (total_pages is not None and page + 1 >= total_pages)):
+            break
+
+    result.update(page_result)
+    result['accounts'] = [match] if match is not None else []
+    result['found'] = match is not None
+    result['message'] = 'Tìm thấy tài khoản' if match is not None else 'Không tìm thấy tài khoản'
+    return result
+
+@ministry_steps
+def query_ministry_accounts(ministry, keyword, access_token, result, page=0, size=10):
+    """Gọi API /hu/user của một Bộ (một trang), điền kết quả vào `result`"""
+    api_url = ministry['endpoints'].get('users')
+
+    if not api_url:
+        result['status'] = 'error'
+        result['message'] = 'Chưa cấu hình API'
+        return result
+
+    params = {
+        'keyword': keyword,
+        'ldap': 0,
+        'page': page,
+        'size': size,
+        'sortField': 'fullname',
+        'sortType': 'asc'
+    }
+
+    headers = {**ministry['headers']['lookup'], 'Authorization': f'Bearer {access_token}'}
+
+    try:
+        response = yield MinistryCall(ministry, 'GET', api_url, params=params, headers=headers, timeout=10)
+
+        if response.status_code == 200:
+            data = response.json()
+
+            # Kiểm tra cấu trúc response
+            if data and 'content' in data:
+                accounts = data['content']
+                if 'totalPages' in data:
+                    result['total_pages'] = data['totalPages']
+                if log_debug_enabled():
+                    log.debug('Kết quả API /hu/user', extra={'ministry': ministry['id'], 'keyword': keyword, 'page': page, 'response': data})
+
+                if accounts and len(accounts) > 0:
+                    result['status'] = 'success'
+                    result['found'] = True
+                    result['accounts'] = accounts
+                    result['message'] = f'Tìm thấy {len(accounts)} tài khoản'
+                else:
+                    result['status'] = 'success'
+                    result['found'] = False
+                    result['message'] = 'Không tìm thấy tài khoản'
+            else:
+                result['status'] = 'success'
+                result['found'] = False
+                result['message'] = 'Không tìm thấy tài khoản'
+        else:
+            result['status'] = 'error'
+            result['message'] = f'Lỗi API: HTTP {response.status_code}'
+
+    except requests.exceptions.Timeout:
+        result['status'] = 'error'
+        result['message'] = 'Timeout'
+    except requests.exceptions.RequestException as e:
+        result['status'] = 'error'
+        result['message'] = f'Lỗi kết nối: {str(e)[:50]}'
+    except Exception as e:
+        result['status'] = 'error'
+        result['message'] = f'Lỗi: {str(e)[:50]}'
+
+    return result
+
+def iter_lookup_results(keyword, user_id, wait_mode='deadline', deadline=None):
+    """Tra cứu song song trên tất cả các Bộ, sinh kết quả theo thứ tự Bộ nào xong trước.
+
+    wait_mode='deadline': hết deadline thì các Bộ chưa trả về được đánh dấu 'timeout' và request của chúng bị hủy.
+    wait_mode='all': chờ tất cả các Bộ.
+    """
+    deadline = LOOKUP_DEADLINE if deadline is None else deadline
+    futures = {submit_ministry_call(lookup_on_ministry, m, keyword, user_id): m for m in ministries}
+
+    # Hạn chờ của từng Bộ tính từ lúc request của Bộ đó bắt đầu chạy. Bộ quá hạn bị hủy
+    # (thread pool: chỉ hủy được request chưa bắt đầu; AsyncBackend: hủy cả request đang chờ phản hồi)
+    for future, timed_out in iter_ministry_calls(futures, deadline if wait_mode == 'deadline' else None):
+        if not timed_out:
+            yield future.result()
+        else:
+            ministry = futures[future]
+            yield {
+                'ministry_id': ministry['id'],
+                'ministry_name': ministry['name'],
+                'status': 'timeout',
+                'found': False,
+                'accounts': [],
+                'message': f'Quá thời gian chờ ({deadline:g}s)'
+            }
+
+def ndjson_line(data):
+    """Một dòng NDJSON"""
+    return json.dumps(data, ensure_ascii=False, default=str) + '\n'
+
+def wants_stream():
+    """Client yêu cầu trả kết quả dạng stream NDJSON (tham số stream=1)"""
+    return request.values.get('stream', '') in ('1', 'true', 'ndjson')
 
 @app.route('/lookup-account', methods=['POST'])
 @login_required
 def lookup_account():
-    """Tra cứu tài khoản trên tất cả các bộ"""
+    """Tra cứu tài khoản song song trên tất cả các bộ.
+
+    wait=all: chờ tất cả các Bộ; mặc định (wait=deadline) trả về sau LOOKUP_DEADLINE giây,
+    Bộ chưa trả về có status 'timeout'. stream=1: trả từng Bộ dạng NDJSON ngay khi có kết quả.
+    """
     keyword = request.form.get('keyword', '').strip()
 
     if not keyword:
         return jsonify({'error': 'Vui lòng nhập từ khóa tra cứu'})
 
+    wait_mode = request.values.get('wait', 'deadline')
+    if wait_mode not in ('all', 'deadline'):
+        return jsonify({'error': 'Tham số wait phải là "all" hoặc "deadline"'})
+
     user_id = session['user_id']
-    user_tokens = get_user_tokens(user_id)
 
-    results = []
+    if wants_stream():
+        def generate():
+            yield ndjson_line({'type': 'start', 'keyword': keyword, 'total': len(ministries)})
+            for result in iter_lookup_results(keyword, user_id, wait_mode):
+                yield ndjson_line({'type': 'result', 'result': result})
+            yield ndjson_line({'type': 'done', 'keyword': keyword})
 
-    # API URLs cho từng bộ
-    api_urls = {
-        1: 'https://api-dvc.moh.gov.vn/hu/user',  # Bộ Y tế
-        2: 'https://apidvc.moet.gov.vn/hu/user',  # Bộ GD&ĐT
-        3: 'https://api-dvc.moha.gov.vn/hu/user',  # Bộ Nội vụ
-        4: 'https://apidichvucong.mst.gov.vn/hu/user',  # Bộ KH&CN
-        5: 'https://api-motcua.moc.gov.vn/hu/user',  # Bộ Xây dựng
-        6: 'https://apigateway-dvcnnmt.mae.gov.vn/hu/user',  # Bộ NN&MT
-        7: 'https://api-tthc.moit.gov.vn/hu/user',  # Bộ Công Thương
-    }
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                        headers={'X-Accel-Buffering': 'no', 'Cache-Control': 'no-cache'})
 
-    for ministry in ministries:
-        ministry_id = ministry['id']
-        ministry_name = ministry['name']
+    # Giữ thứ tự kết quả theo danh sách Bộ
+    order = {m['id']: i for i, m in enumerate(ministries)}
+    results = sorted(iter_lookup_results(keyword, user_id, wait_mode), key=lambda r: order[r['ministry_id']])
 
-        result = {
-            'ministry_id': ministry_id,
-            'ministry_name': ministry_name,
-            'status': 'pending',
-            'found': False,
-            'accounts': [],
-            'message': ''
-        }
+    return jsonify({'success': True, 'results': results, 'keyword': keyword, 'wait': wait_mode})
 
-        # Kiểm tra token
-        if ministry_id not in user_tokens:
-            result['status'] = 'no_token'
-            result['message'] = 'Chưa đồng bộ token'
-            results.append(result)
-            continue
+def bulk_lookup(user_id, keywords, ministry_list=None, matrix=None, exact=False):
+    """Tra cứu nhiều từ khóa trên các Bộ; mỗi Bộ tối đa BULK_LOOKUP_CONCURRENCY request song song.
 
-        access_token = user_tokens[ministry_id]['access_token']
+    Trả về {keyword: {ministry_id: kết quả theo Bộ}}. Truyền `matrix` để theo dõi tiến độ trong lúc chạy.
+    exact=True: từ khóa là username, chỉ lấy tài khoản khớp chính xác (xem query_exact_account).
+    """
+    ministry_list = ministry_list if ministry_list is not None else ministries
+    if matrix is None:
+        matrix = {}
+    matrix.update({keyword: {} for keyword in keywords})
 
-        # Kiểm tra token hết hạn
-        if user_tokens[ministry_id]['expires_at'] < datetime.now():
-            result['status'] = 'token_expired'
-            result['message'] = 'Token đã hết hạn'
-            results.append(result)
-            continue
+    backend = get_async_backend()
+    if backend:
+        backend.submit(bulk_lookup_async(user_id, keywords, ministry_list, matrix, exact)).result()
+        return matrix
 
-        # Gọi API tra cứu
-        api_url = api_urls.get(ministry_id)
+    executors = {m['id']: ThreadPoolExecutor(max_workers=BULK_LOOKUP_CONCURRENCY, thread_name_prefix=f"bulk-{m['id']}")
+                 for m in ministry_list}
+    try:
+        futures = {}
+        for keyword in keywords:
+            for ministry in ministry_list:
+                future = submit_with_log_context(executors[ministry['id']], lookup_on_ministry, ministry, keyword, user_id, True, exact)
+                futures[future] = (keyword, ministry['id'])
+
+        for future in as_completed(futures):
+            keyword, ministry_id = futures[future]
+            matrix[keyword][ministry_id] = future.result()
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=False)
+
+    return matrix
+
+async def bulk_lookup_async(user_id, keywords, ministry_list, matrix, exact=False):
+    """bulk_lookup trên event loop: giới hạn BULK_LOOKUP_CONCURRENCY request mỗi Bộ bằng semaphore"""
+    limits = {m['id']: asyncio.Semaphore(BULK_LOOKUP_CONCURRENCY) for m in ministry_list}
+
+    async def lookup(keyword, ministry):
+        async with limits[ministry['id']]:
+            matrix[keyword][ministry['id']] = await lookup_on_ministry.run_async(ministry, keyword, user_id, True, exact)
+
+    await asyncio.gather(*(lookup(keyword, ministry) for keyword in keywords for ministry in ministry_list))
+
+def read_bulk_keywords():
+    """Lấy danh sách từ khóa từ ô nhập (mỗi dòng / dấu phẩy một từ khóa) hoặc file Excel/CSV"""
+    keywords = []
+    text = request.form.get('keywords', '')
+    for line in text.replace(';', '\n').replace(',', '\n').splitlines():
+        keywords.append(line.strip())
+
+    file = request.files.get('file')
+    if file and file.filename:
+        fd, path = tempfile.mkstemp(prefix='bulk-', suffix=os.path.splitext(file.filename)[1])
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(file.stream, f)
+        try:
+            header, rows = open_account_file(path, file.filename)
+            # Lấy cột username/keyword nếu có, không thì cột đầu tiên (dòng đầu cũng là dữ liệu)
+            column = next((header.index(name) for name in ('username', 'keyword') if name in header), None)
+            if column is None:
+                column = 0
+                keywords.append(header[0] if header else '')
+            for _, values in rows:
+                if column < len(values):
+                    keywords.append(cell_to_str(values[column]))
+            rows.close()
+        finally:
+            os.remove(path)
+
+    # Bỏ trùng, giữ thứ tự
+    return list(dict.fromkeys(keyword for keyword in keywords if keyword))
+
+def account_username(account):
+    """Username đầu tiên của một tài khoản trả về từ API /hu/user"""
+    usernames = (account.get('account') or {}).get('username') or [{}]
+    return usernames[0].get('value', '')
+
+def bulk_lookup_csv(keywords, matrix, ministry_list):
+    """Xuất ma trận tra cứu hàng loạt ra CSV (UTF-8 có BOM để mở bằng Excel)"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['keyword'] + [m['name'] for m in ministry_list])
+
+    for keyword in keywords:
+        row = [keyword]
+        for ministry in ministry_list:
+            result = matrix[keyword].get(ministry['id'], {})
+            if result.get('found'):
+                usernames = [account_username(account) for account in result['accounts']]
+                row.append(f"Có ({len(result['accounts'])}): {' '.join(u for u in usernames if u)}")
+            elif result.get('status') == 'success':
+                row.append('Không')
+            else:
+                row.append(result.get('message') or result.get('status', ''))
+        writer.writerow(row)
 
-        if not api_url:
-            result['status'] = 'error'
-            result['message'] = 'Chưa cấu hình API'
-            results.append(result)
-            continue
+    return '\ufeff' + output.getvalue()
 
-        params = {
-            'keyword': keyword,
-            'ldap': 0,
-            'page': 0,
-            'size': 10,
-            'sortField': 'fullname',
-            'sortType': 'asc'
-        }
+def run_bulk_job(job, ministry_list, state_file):
+    """Thread nền: chạy tra cứu hàng loạt của job, xong thì ghi kết quả ra file trạng thái cho các worker khác"""
+    try:
+        bulk_lookup(job['user_id'], job['keywords'], ministry_list, job['matrix'])
+    except Exception as e:
+        log.exception('Lỗi tra cứu hàng loạt', extra={'job_id': job['id']})
+        job['error'] = f'Lỗi khi tra cứu: {str(e)[:100]}'
+    finally:
+        finished_at = datetime.now()
+        try:
+            save_job_state(state_file, {
+                'id': job['id'],
+                'user_id': job['user_id'],
+                'status': 'done',
+                'error': job['error'],
+                'created_at': job['created_at'].isoformat(),
+                'finished_at': finished_at.isoformat(),
+                'keywords': job['keywords'],
+                'ministry_ids': job['ministry_ids'],
+                'matrix': job['matrix']
+            })
+        except Exception:
+            log.exception('Lỗi ghi trạng thái job tra cứu hàng loạt', extra={'job_id': job['id']})
+        with import_jobs_lock:
+            job['status'] = 'done'
+            job['finished_at'] = finished_at
+
+def load_bulk_job(job_id):
+    """Job tra cứu hàng loạt của worker khác (đọc từ file trạng thái); 'running' nếu job còn đang chạy"""
+    state = load_job_state('bulk', job_id)
+    if not isinstance(state, dict):
+        return state
+    return {
+        **state,
+        'created_at': datetime.fromisoformat(state['created_at']),
+        'finished_at': datetime.fromisoformat(state['finished_at']),
+        # JSON đổi khóa ministry_id thành chuỗi
+        'matrix': {keyword: {int(ministry_id): result for ministry_id, result in cells.items()}
+                   for keyword, cells in state['matrix'].items()}
+    }
 
-        headers = {
-            'accept': '*/*',
-            'accept-language': 'vi,fr-FR;q=0.9,fr;q=0.8,en-US;q=0.7,en;q=0.6',
-            'Authorization': f'Bearer {access_token}'
-        }
+def job_state_path(kind, job_id):
+    """Đường dẫn file trạng thái của job nền (job_id phải là uuid hex để tránh path traversal)"""
+    if not re.fullmatch(r'[0-9a-f]{32}', job_id or ''):
+        return None
+    return os.path.join(JOB_STATE_DIR, f'{kind}-{job_id}.json')
+
+def lock_job_state(kind, job_id):
+    """Tạo file trạng thái của job nền và giữ khóa (flock) tới khi job ghi kết quả xong"""
+    os.makedirs(JOB_STATE_DIR, exist_ok=True)
+    state_file = open(job_state_path(kind, job_id), 'w', encoding='utf-8')
+    fcntl.flock(state_file, fcntl.LOCK_EX)
+    return state_file
 
+def save_job_state(state_file, state):
+    """Ghi kết quả của job vào file trạng thái rồi nhả khóa"""
+    try:
+        json.dump(state, state_file, ensure_ascii=False)
+    finally:
+        state_file.close()
+
+def load_job_state(kind, job_id):
+    """Job nền không có trong bộ nhớ của worker này: 'running' nếu file trạng thái còn bị khóa
+    (job đang chạy ở worker khác), dict kết quả nếu job đã xong, None nếu không có (hoặc worker chạy job đã chết)"""
+    path = job_state_path(kind, job_id)
+    if path is None:
+        return None
+    try:
+        with open(path, encoding='utf-8') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 'running'
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def job_running_elsewhere():
+    """Phản hồi khi job đang chạy ở worker khác: client hỏi lại sau"""
+    return jsonify({'error': 'Job đang chạy ở tiến trình khác', 'running': True}), 409
+
+def cleanup_job_states(kind):
+    """Xóa các file trạng thái `kind` quá IMPORT_JOB_TTL, bỏ qua file còn bị khóa (job đang chạy)"""
+    try:
+        names = os.listdir(JOB_STATE_DIR)
+    except OSError:
+        return
+    cutoff = time.time() - IMPORT_JOB_TTL.total_seconds()
+    for name in names:
+        if not name.startswith(f'{kind}-'):
+            continue
+        path = os.path.join(JOB_STATE_DIR, name)
         try:
-            response = requests.get(api_url, params=params, headers=headers, timeout=10)
+            if os.path.getmtime(path) > cutoff:
+                continue
+            with open(path, encoding='utf-8') as f:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.remove(path)
+        except (OSError, BlockingIOError):
+            continue
 
-            if response.status_code == 200:
-                data = response.json()
+def cleanup_finished_jobs(jobs, kind):
+    """Xóa khỏi `jobs` (bulk_jobs, preflight_jobs) và khỏi JOB_STATE_DIR các job đã kết thúc quá IMPORT_JOB_TTL"""
+    now = datetime.now()
+    with import_jobs_lock:
+        expired = [job_id for job_id, job in jobs.items()
+                   if job['finished_at'] and now - job['finished_at'] > IMPORT_JOB_TTL]
+        for job_id in expired:
+            del jobs[job_id]
+    cleanup_job_states(kind)
+
+@app.route('/lookup-accounts/bulk', methods=['POST'])
+@login_required
+def bulk_lookup_accounts():
+    """Tạo job tra cứu hàng loạt (ma trận từ khóa x Bộ) chạy nền; theo dõi qua /lookup-accounts/bulk/<job_id>"""
+    try:
+        keywords = read_bulk_keywords()
+    except Exception as e:
+        return jsonify({'error': f'Lỗi khi đọc file: {str(e)}'})
 
-                # Kiểm tra cấu trúc response
-                if data and 'content' in data:
-                    accounts = data['content']
-                    print(data)
+    if not keywords:
+        return jsonify({'error': 'Vui lòng nhập danh sách từ khóa hoặc chọn file'})
 
-                    if accounts and len(accounts) > 0:
-                        result['status'] = 'success'
-                        result['found'] = True
-                        result['accounts'] = accounts
-                        result['message'] = f'Tìm thấy {len(accounts)} tài khoản'
-                    else:
-                        result['status'] = 'success'
-                        result['found'] = False
-                        result['message'] = 'Không tìm thấy tài khoản'
-                else:
-                    result['status'] = 'success'
-                    result['found'] = False
-                    result['message'] = 'Không tìm thấy tài khoản'
-            else:
-                result['status'] = 'error'
-                result['message'] = f'Lỗi API: HTTP {response.status_code}'
+    if len(keywords) > BULK_LOOKUP_MAX_KEYWORDS:
+        return jsonify({'error': f'Tối đa {BULK_LOOKUP_MAX_KEYWORDS} từ khóa mỗi lần tra cứu'})
 
-        except requests.exceptions.Timeout:
-            result['status'] = 'error'
-            result['message'] = 'Timeout'
-        except requests.exceptions.RequestException as e:
-            result['status'] = 'error'
-            result['message'] = f'Lỗi kết nối: {str(e)[:50]}'
-        except Exception as e:
-            result['status'] = 'error'
-            result['message'] = f'Lỗi: {str(e)[:50]}'
-
-        results.append(result)
-
-    return jsonify({'success': True, 'results': results, 'keyword': keyword})
-
-def get_agency_tree(ministry, keyword, access_token):
-    """Lấy thông tin agency từ API tree-view"""
-    agency_api_urls = {
-        1: 'https://api-dvc.moh.gov.vn/ba/agency/tree-view',  # Bộ Y tế
-        2: 'https://apidvc.moet.gov.vn/ba/agency/tree-view',  # Bộ GD&ĐT
-        3: 'https://api-dvc.moha.gov.vn/ba/agency/tree-view',  # Bộ Nội vụ
-        4: 'https://apidichvucong.mst.gov.vn/ba/agency/tree-view',  # Bộ KH&CN
-        5: 'https://api-motcua.moc.gov.vn/ba/agency/tree-view',  # Bộ Xây dựng
-        6: 'https://apigateway-dvcnnmt.mae.gov.vn/ba/agency/tree-view',  # Bộ NN&MT
-        7: 'https://api-tthc.moit.gov.vn/ba/agency/tree-view',  # Bộ Công Thương
+    selected_ministries = request.form.get('ministries', '')
+    try:
+        selected_ids = {int(x.strip()) for x in selected_ministries.split(',')} if selected_ministries else None
+    except ValueError:
+        return jsonify({'error': 'Định dạng Bộ không hợp lệ'})
+    ministry_list = [m for m in ministries if selected_ids is None or m['id'] in selected_ids]
+
+    cleanup_finished_jobs(bulk_jobs, 'bulk')
+    job = {
+        'id': uuid.uuid4().hex,
+        'user_id': session['user_id'],
+        'status': 'running',
+        'error': None,
+        'created_at': datetime.now(),
+        'finished_at': None,
+        'keywords': keywords,
+        'ministry_ids': [m['id'] for m in ministry_list],
+        'matrix': {}  # {keyword: {ministry_id: kết quả}}, được điền dần trong lúc chạy
     }
+    state_file = lock_job_state('bulk', job['id'])
+    with import_jobs_lock:
+        bulk_jobs[job['id']] = job
+
+    threading.Thread(target=contextvars.copy_context().run, args=(run_bulk_job, job, ministry_list, state_file), daemon=True,
+                     name=f"bulk-lookup-{job['id'][:8]}").start()
 
-    api_url = agency_api_urls.get(ministry['id'])
+    return jsonify({'success': True, 'job_id': job['id'], 'total': len(keywords) * len(ministry_list)})
+
+@app.route('/lookup-accounts/bulk/<job_id>')
+@login_required
+def get_bulk_lookup_job(job_id):
+    """Tiến độ của job tra cứu hàng loạt; xong thì trả ma trận kết quả (format=csv để xuất file)"""
+    job = bulk_jobs.get(job_id) or load_bulk_job(job_id)
+    if job == 'running':
+        return job_running_elsewhere()
+    if not job or job['user_id'] != session['user_id']:
+        return jsonify({'error': 'Không tìm thấy job tra cứu'}), 404
+
+    ministry_list = [ministries_by_id[ministry_id] for ministry_id in job['ministry_ids']]
+    total = len(job['keywords']) * len(ministry_list)
+    done = sum(len(cells) for cells in list(job['matrix'].values()))
+    if job['status'] != 'done' or job['error']:
+        return jsonify({'success': job['error'] is None, 'job_id': job['id'], 'status': job['status'],
+                        'error': job['error'], 'done': done, 'total': total})
+
+    keywords, matrix = job['keywords'], job['matrix']
+    if request.values.get('format') == 'csv':
+        filename = f"tra_cuu_hang_loat_{job['created_at']:%Y%m%d_%H%M%S}.csv"
+        return Response(bulk_lookup_csv(keywords, matrix, ministry_list), mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+    rows = []
+    for keyword in keywords:
+        cells = {}
+        for ministry in ministry_list:
+            result = matrix[keyword][ministry['id']]
+            cells[ministry['id']] = {
+                'status': result['status'],
+                'found': result['found'],
+                'count': len(result['accounts']),
+                'message': result['message'],
+                'accounts': [{
+                    'id': account.get('id'),
+                    'fullname': account.get('fullname'),
+                    'username': account_username(account)
+                } for account in result['accounts']]
+            }
+        rows.append({'keyword': keyword, 'results': cells})
+
+    return jsonify({
+        'success': True,
+        'job_id': job['id'],
+        'status': job['status'],
+        'done': done,
+        'total': total,
+        'ministries': [{'id': m['id'], 'name': m['name']} for m in ministry_list],
+        'rows': rows
+    })
+
+@ministry_steps
+@timed_stage('agency_resolve')
+def get_agency_tree(ministry, keyword, access_token, parent_id=None):
+    """Lấy thông tin agency từ API tree-view (có cache theo (Bộ, keyword, agency cha));
+    parent_id giới hạn tìm kiếm trong cây con của agency cha, raise AmbiguousAgencyError nếu trùng tên"""
+    keyword = (keyword or '').strip()
+
+    # Tra cứu cục bộ trên cây agency đã tải sẵn (lần đầu đọc từ file)
+    index = yield BlockingCall(get_agency_index, ministry, access_token)
+    if index is not None:
+        agency = index.resolve(keyword, parent_id)
+        if agency is not None:
+            return agency
+
+    try:
+        return (yield from agency_cache.load_steps(
+            (ministry['id'], keyword, parent_id or ''),
+            lambda: fetch_agency_tree.steps(ministry, keyword, access_token, parent_id)
+        ))
+    except AmbiguousAgencyError:
+        raise
+    except Exception as e:
+        log.warning('Lỗi tra cứu agency: %s', e, extra={'ministry': ministry['id'], 'keyword': keyword})
+        return None
+
+@ministry_steps
+def fetch_agency_tree(ministry, keyword, access_token, parent_id=None):
+    """Gọi API tree-view; trả về agency khớp đúng tên/mã (hoặc kết quả đầu tiên), None nếu không tìm thấy,
+    raise AmbiguousAgencyError nếu nhiều agency trùng tên, raise nếu lỗi"""
+    data = yield from request_agency_tree.steps(ministry, access_token, keyword, {'parent-id': parent_id} if parent_id else None)
+
+    if data and 'content' in data and isinstance(data['content'], list) and len(data['content']) > 0:
+        exact = [agency for agency in data['content']
+                 if isinstance(agency, dict) and keyword in ((agency.get('name') or '').strip(), (agency.get('code') or '').strip())]
+        if len(exact) > 1:
+            raise AmbiguousAgencyError(keyword, exact)
+        return exact[0] if exact else data['content'][0]
+
+    return None
+
+@ministry_steps
+def request_agency_tree(ministry, access_token, keyword, extra_params=None):
+    """Gọi API tree-view và trả về JSON; None nếu Bộ chưa cấu hình API, raise nếu lỗi"""
+    api_url = ministry['endpoints'].get('agency_tree')
 
     if not api_url:
         return None
@@ -399,177 +2341,167 @@ def get_agency_tree(ministry, keyword, access_token):
         'tag-id': '',
         'sort': ''
     }
+    if extra_params:
+        params.update(extra_params)
 
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Accept': 'application/json'
-    }
+    headers = {**ministry['headers']['agency'], 'Authorization': f'Bearer {access_token}'}
 
-    try:
-        response = requests.get(api_url, params=params, headers=headers, timeout=10)
+    response = yield MinistryCall(ministry, 'GET', api_url, params=params, headers=headers, timeout=10)
 
-        if response.status_code == 200:
-            data = response.json()
+    if response.status_code != 200:
+        raise requests.exceptions.HTTPError(f'HTTP {response.status_code}', response=response)
 
-            if data and 'content' in data and isinstance(data['content'], list) and len(data['content']) > 0:
-                return data['content'][0]
+    return response.json()
 
-        return None
+def download_agency_tree(ministry, access_token):
+    """Tải toàn bộ cây agency của một Bộ (theo trang), trả về danh sách agency đã làm phẳng"""
+    agencies = []
+
+    def collect(items, parent=None):
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            agency = {k: v for k, v in item.items() if k != 'children'}
+            if parent and not agency.get('parent') and not agency.get('parentId'):
+                agency['parent'] = {'id': parent.get('id'), 'name': parent.get('name')}
+            agencies.append(agency)
+            collect(item.get('children') or [], agency)
+
+    page = 0
+    while True:
+        data = request_agency_tree(ministry, access_token, '', {'page': page, 'size': AGENCY_INDEX_PAGE_SIZE})
+        content = data.get('content') if isinstance(data, dict) else None
+        collect(content or [])
+
+        total_pages = data.get('totalPages', 1) if isinstance(data, dict) else 1
+        page += 1
+        if not content or page >= total_pages:
+            break
+
+    return agencies
+
+def refresh_agency_index(ministry, access_token):
+    """Tải lại cây agency của một Bộ, cập nhật index và lưu ra đĩa"""
+    with agency_index_lock:
+        if ministry['id'] in agency_index_loading:
+            return agency_indexes.get(ministry['id'])
+        agency_index_loading.add(ministry['id'])
+
+    try:
+        agencies = download_agency_tree(ministry, access_token)
+        if not agencies:
+            # Không thay cây đang có (hoặc file đã lưu) bằng cây rỗng
+            raise ValueError('cây agency rỗng')
+        index = AgencyIndex(ministry['id'], agencies)
+        with agency_index_lock:
+            agency_indexes[ministry['id']] = index
+            agency_index_failed_at.pop(ministry['id'], None)
+        try:
+            index.save()
+        except OSError as e:
+            log.warning('Không lưu được cây agency: %s', e, extra={'ministry': ministry['id']})
+        log.info('Đã tải cây agency', extra={'ministry': ministry['id'], 'agencies': len(index.agencies)})
+        return index
     except Exception as e:
-        print(f"DEBUG get_agency_tree error: {e}")
+        log.warning('Lỗi tải cây agency: %s', e, extra={'ministry': ministry['id']})
+        with agency_index_lock:
+            agency_index_failed_at[ministry['id']] = time.monotonic()
         return None
+    finally:
+        with agency_index_lock:
+            agency_index_loading.discard(ministry['id'])
+
+def get_agency_index(ministry, access_token=None):
+    """Index cây agency của một Bộ; tự tải nền (lần đầu hoặc khi quá hạn) nếu có token.
 
+    Lần tải trước bị lỗi thì chờ AGENCY_INDEX_RETRY_AFTER giây mới tự tải lại.
+    """
+    if not AGENCY_INDEX_ENABLED:
+        return None
 
+    index = agency_indexes.get(ministry['id'])
+    if index is None:
+        with agency_index_lock:
+            index = agency_indexes.get(ministry['id'])
+            if index is None:
+                index = AgencyIndex.load(ministry['id'])
+                if index is not None:
+                    agency_indexes[ministry['id']] = index
+
+    failed_at = agency_index_failed_at.get(ministry['id'])
+    if (access_token and (index is None or index.is_stale()) and ministry['id'] not in agency_index_loading
+            and (failed_at is None or time.monotonic() - failed_at >= AGENCY_INDEX_RETRY_AFTER)):
+        background_executor.submit(refresh_agency_index, ministry, access_token)
+
+    return index
+
+# Các chức vụ có trong bảng chức vụ của ít nhất một Bộ; chức vụ khác dùng chức vụ mặc định của Bộ
+KNOWN_POSITIONS = frozenset(role for _, role in ministry_positions)
+
+def get_position(ministry_id, position_keyword):
+    """Ánh xạ chức vụ trong Excel sang (position_id, position_name) của từng Bộ"""
+    position = ministry_positions.get((ministry_id, position_keyword))
+    if position:
+        return position
+    ministry = ministries_by_id.get(ministry_id)
+    return ministry['default_position'] if ministry else default_position
+
+def agency_ref(agency_info):
+    """(id, name) của agency trả về từ get_agency_tree (agency, hoặc dạng {'content': ...}); ("", None) nếu không có"""
+    if not agency_info:
+        return "", None
+    content = agency_info.get('content', agency_info)
+    if isinstance(content, list):
+        content = content[0] if content else {}
+    if not isinstance(content, dict):
+        content = agency_info
+    return content.get('id', ''), content.get('name')
+
+@ministry_steps
+@timed_stage('experience')
 def update_user_experience(ministry, user_id, account_data, access_token):
     """Cập nhật quá trình công tác cho user"""
-    experience_api_urls = {
-        1: 'https://api-dvc.moh.gov.vn/hu/user',  # Bộ Y tế
-        2: 'https://apidvc.moet.gov.vn/hu/user',  # Bộ GD&ĐT
-        3: 'https://api-dvc.moha.gov.vn/hu/user',  # Bộ Nội vụ
-        4: 'https://apidichvucong.mst.gov.vn/hu/user',  # Bộ KH&CN
-        5: 'https://api-motcua.moc.gov.vn/hu/user',  # Bộ Xây dựng
-        6: 'https://apigateway-dvcnnmt.mae.gov.vn/hu/user',  # Bộ NN&MT
-        7: 'https://api-tthc.moit.gov.vn/hu/user',  # Bộ Công Thương
-    }
-
-    base_url = experience_api_urls.get(ministry['id'])
+    experience_url = ministry['endpoints'].get('experience')
 
-    if not base_url:
+    if not experience_url:
         return {'success': False, 'message': 'Chưa cấu hình API experience'}
 
-    # Xử lý agency parent từ Excel - lấy trực tiếp từ agencyDepartment
+    # Xử lý agency parent từ Excel
     agency_parent = account_data.get('agencyParent', '')
+    agency_parent_id = ""
 
     # Xử lý agency department từ Excel
     agency_dept_keyword = account_data.get('agencyDepartment', '')
     agency_dept_id = ""
     agency_dept_name = None
-    agency_dept_parent_id = ""
-
-    if agency_dept_keyword:
-        # Gọi API tree-view để lấy thông tin agency department
-        agency_dept_info = get_agency_tree(ministry, agency_dept_keyword, access_token)
-        print(f"DEBUG update_user_experience: agency_dept_info = {agency_dept_info}")
-
-        if agency_dept_info:
-            # Xử lý tương tự như agency parent
-            if 'content' in agency_dept_info:
-                content = agency_dept_info['content']
-                if isinstance(content, list) and len(content) > 0:
-                    agency_dept_id = content[0].get('id', '')
-                    agency_dept_name = content[0].get('name')
-                    # Lấy parent_id từ content[0]
-                    agency_dept_parent_id = content[0].get('id', '')
-                elif isinstance(content, dict):
-                    agency_dept_id = content.get('id', '')
-                    agency_dept_name = content.get('name')
-                    agency_dept_parent_id = content.get('id', '')
-                else:
-                    agency_dept_id = agency_dept_info.get('id', '')
-                    agency_dept_name = agency_dept_info.get('name')
-                    agency_dept_parent_id = agency_dept_info.get('id', '')
-            else:
-                agency_dept_id = agency_dept_info.get('id', '')
-                agency_dept_name = agency_dept_info.get('name')
-                agency_dept_parent_id = agency_dept_info.get('id', '')
-    else:
-        # Nếu không có agencyDepartment, sử dụng agencyParent làm agency chính
-        agency_dept_parent_id = ""
-        agency_dept_id = ""
-        agency_dept_name = None
+
+    try:
+        if agency_parent:
+            # Tra agency cha trước để tìm agencyDepartment trong cây con của nó (tên phòng ban hay trùng giữa các đơn vị)
+            agency_info = yield from get_agency_tree.steps(ministry, agency_parent, access_token)
+            agency_parent_id, _ = agency_ref(agency_info)
+
+        if agency_dept_keyword:
+            # Gọi API tree-view để lấy thông tin agency department
+            agency_dept_info = yield from get_agency_tree.steps(ministry, agency_dept_keyword, access_token, agency_parent_id or None)
+            if log_debug_enabled():
+                log.debug('Agency department', extra={'ministry': ministry['id'], 'keyword': agency_dept_keyword, 'agency': agency_dept_info})
+            agency_dept_id, agency_dept_name = agency_ref(agency_dept_info)
+    except AmbiguousAgencyError as e:
+        return {'success': False, 'message': str(e)}
 
     # Xử lý position từ Excel
     position_keyword = account_data.get('position', '')
-  
-    match ministry['id']:
-        case 1:  # Bộ Y tế
-            match position_keyword:
-                case "Cán bộ tiếp nhận":
-                    position_id = "63da27faee48c32f84775aa7"
-                    position_name = "Cán bộ một cửa"
-                case "Chuyên viên":
-                    position_id = "63d86b35ee48c32f84775a99"
-                    position_name = "Chuyên viên"
-                case "Lãnh đạo phòng":   
-                    position_id = "63d86b2eee48c32f84775a98"
-                    position_name = "Lãnh đạo"
-                case "Lãnh đạo đơn vị":
-                    position_id = "63d86b2eee48c32f84775a98"
-                    position_name = "Lãnh đạo"
-                case _:
-                    position_id = "63d86b35ee48c32f84775a99"
-                    position_name = "Chuyên viên"
-        case 2:  # Bộ GD&ĐT
-            match position_keyword:
-                case "Cán bộ tiếp nhận":
-                    position_id = "63da27faee48c32f84775aa7"
-                    position_name = "Cán bộ một cửa"
-                case "Chuyên viên":
-                    position_id = "63d86b35ee48c32f84775a99"
-                    position_name = "Chuyên viên"
-                case "Lãnh đạo phòng":   
-                    position_id = "676323499be21b2c69676323"
-                    position_name = "Lãnh đạo phòng"
-                case "Lãnh đạo đơn vị":
-                    position_id = "67f7008a5caf25886f67f700"
-                    position_name = "Lãnh đạo UBND"
-                case _:
-                    position_id = "63d86b35ee48c32f84775a99"
-                    position_name = "Chuyên viên"
-        case 3:  # Bộ Nội vụ
-            match position_keyword:
-                case "Cán bộ tiếp nhận":
-                    position_id = "691403b85d64c445d3f144bb"
-                    position_name = "Công chức tiếp nhận hồ sơ và TKQ"
-                case "Lãnh đạo phòng":   
-                    position_id = "67452ec3bcb70f68d3aa44d9"
-                    position_name = "Lãnh đạo phòng"
-                case "Lãnh đạo đơn vị":
-                    position_id = "691403d7aaa2404972604d84"
-                    position_name = "Lãnh đạo đơn vị"
-                case "Chuyên viên":
-                    position_id = "673d9ac1e83ede4465d14542"
-                    position_name = "Chuyên viên"
-                case _:
-                    position_id = "673d9ac1e83ede4465d14542"
-                    position_name = "Chuyên viên"
-        case 4:  # Bộ KH&CN
-            position_id = "63d86b35ee48c32f84775a99"
-            position_name = "Chuyên viên"
-        case 5:  # Bộ Xây dựng
-            position_id = "63d86b35ee48c32f84775a99"
-            position_name = "Chuyên viên"
-        case 6:  # Bộ NN&MT
-            position_id = "63d86b35ee48c32f84775a99"
-            position_name = "Chuyên viên"
-        case 7:  # Bộ Công Thương
-            position_id = "63d86b35ee48c32f84775a99"
-            position_name = "Chuyên viên"
-        case _:
-            position_id = "63d86b35ee48c32f84775a99"
-            position_name = "Chuyên viên"
-        # Nếu không có agency_dept_parent_id, sử dụng agency_dept_id
-    if not agency_dept_parent_id and agency_dept_id:
-        agency_dept_parent_id = agency_dept_id
-
-    # Nếu vẫn không có, lấy từ keyword agencyParent
-    if not agency_dept_parent_id and agency_parent:
-        # Thử tìm agency parent từ API
-        agency_info = get_agency_tree(ministry, agency_parent, access_token)
-        if agency_info:
-            if 'content' in agency_info:
-                content = agency_info['content']
-                if isinstance(content, list) and len(content) > 0:
-                    agency_dept_parent_id = content[0].get('id', '')
-                elif isinstance(content, dict):
-                    agency_dept_parent_id = content.get('id', '')
-            else:
-                agency_dept_parent_id = agency_info.get('id', '')
+    position_id, position_name = get_position(ministry['id'], position_keyword)
+
+    # Agency của quá trình công tác: agencyDepartment nếu tìm thấy, nếu không thì agencyParent
+    agency_dept_parent_id = agency_dept_id or agency_parent_id
 
     if not agency_dept_parent_id:
         return {'success': False, 'message': 'Không tìm thấy agency cha. Vui lòng kiểm tra mã đơn vị.'}
 
-    print(f"DEBUG update_user_experience: agency_dept_parent_id = {agency_dept_parent_id}, agency_parent = {agency_parent}")
+    if log_debug_enabled():
+        log.debug('Agency cha', extra={'ministry': ministry['id'], 'agency_id': agency_dept_parent_id, 'agency_parent': agency_parent})
 
     # Chuẩn bị payload cho experience
     from datetime import datetime, timezone
@@ -595,22 +2527,14 @@ def update_user_experience(ministry, user_id, account_data, access_token):
         }
     ]
 
-    print(experience_payload)
-
-    api_url = f"{base_url}/{user_id}/experience?checkAgencyEx=true"
+    if log_debug_enabled():
+        log.debug('Payload experience', extra={'ministry': ministry['id'], 'user_id': user_id, 'payload': experience_payload})
 
-    headers = {
-        'Accept': 'application/json, text/plain, */*',
-        'Accept-Language': 'vi',
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json',
-        'Origin': ministry['url'],
-        'Referer': ministry['url'] + '/',
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-    }
+    api_url = experience_url.format(user_id=user_id)
+    headers = {**ministry['headers']['write'], 'Authorization': f'Bearer {access_token}'}
 
     try:
-        response = requests.put(api_url, json=experience_payload, headers=headers, timeout=30)
+        response = yield MinistryCall(ministry, 'PUT', api_url, json=experience_payload, headers=headers, timeout=30)
 
         if response.status_code in [200, 201, 204]:
             return {'success': True, 'message': 'Cập nhật quá trình công tác thành công'}
@@ -627,19 +2551,14 @@ def update_user_experience(ministry, user_id, account_data, access_token):
     except Exception as e:
         return {'success': False, 'message': f'Lỗi: {str(e)[:50]}'}
 
-def create_account_on_ministry(ministry, account_data, access_token):
-    """Tạo tài khoản trên một bộ"""
-    api_urls = {
-        1: 'https://api-dvc.moh.gov.vn/hu/user/--fully',  # Bộ Y tế
-        2: 'https://apidvc.moet.gov.vn/hu/user/--fully',  # Bộ GD&ĐT
-        3: 'https://api-dvc.moha.gov.vn/hu/user/--fully',  # Bộ Nội vụ
-        4: 'https://apidichvucong.mst.gov.cn/hu/user/--fully',  # Bộ KH&CN
-        5: 'https://api-motcua.moc.gov.vn/hu/user/--fully',  # Bộ Xây dựng
-        6: 'https://apigateway-dvcnnmt.mae.gov.vn/hu/user/--fully',  # Bộ NN&MT
-        7: 'https://api-tthc.moit.gov.vn/hu/user/--fully',  # Bộ Công Thương
-    }
+@ministry_steps
+def create_account_on_ministry(ministry, account_data, access_token, update_experience=True):
+    """Tạo tài khoản trên một bộ.
 
-    api_url = api_urls.get(ministry['id'])
+    update_experience=False: không cập nhật quá trình công tác ngay mà trả về 'experience_pending'
+    để pipeline import làm ở bước sau.
+    """
+    api_url = ministry['endpoints'].get('create_user')
 
     if not api_url:
         return {'success': False, 'message': 'Chưa cấu hình API'}
@@ -679,28 +2598,31 @@ def create_account_on_ministry(ministry, account_data, access_token):
         "taxCode": None
     }
 
-    headers = {
-        'Accept': 'application/json, text/plain, */*',
-        'Accept-Language': 'vi',
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json',
-        'Origin': ministry['url'],
-        'Referer': ministry['url'] + '/',
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-    }
+    headers = {**ministry['headers']['write'], 'Authorization': f'Bearer {access_token}'}
 
     try:
-        response = requests.post(api_url, json=payload, headers=headers, timeout=30)
+        with stage_timer('create', ministry['id']):
+            response = yield MinistryCall(ministry, 'POST', api_url, json=payload, headers=headers, timeout=30)
 
         if response.status_code in [200, 201]:
+            # Kết quả tra cứu cũ không còn đúng sau khi tạo tài khoản
+            invalidate_lookup_cache(ministry['id'], account_data)
+
             # Lấy user_id từ response
             try:
                 response_data = response.json()
                 user_id = response_data.get('id') if isinstance(response_data, dict) else None
 
                 # Nếu tạo thành công và có agencyParent thì cập nhật experience
-                if user_id and account_data.get('agencyParent'):
-                    experience_result = update_user_experience(ministry, user_id, account_data, access_token)
+                if user_id and account_data.get('agencyParent') and not update_experience:
+                    return {
+                        'success': True,
+                        'message': 'Tạo tài khoản thành công',
+                        'user_id': user_id,
+                        'experience_pending': True
+                    }
+                elif user_id and account_data.get('agencyParent'):
+                    experience_result = yield from update_user_experience.steps(ministry, user_id, account_data, access_token)
 
                     if experience_result['success']:
                         return {
@@ -721,7 +2643,7 @@ def create_account_on_ministry(ministry, account_data, access_token):
                         'message': 'Tạo tài khoản thành công',
                         'user_id': user_id
                     }
-            except:
+            except Exception:
                 return {'success': True, 'message': 'Tạo thành công'}
         else:
             return {
@@ -736,158 +2658,1216 @@ def create_account_on_ministry(ministry, account_data, access_token):
     except Exception as e:
         return {'success': False, 'message': f'Lỗi: {str(e)[:50]}'}
 
-@app.route('/import-accounts', methods=['POST'])
-@login_required
-def import_accounts():
-    """Import tài khoản từ file Excel"""
+def import_account_cell(ministry_id, account_data, user_id, mode='create', existing=False, existing_user_id=None):
+    """Tạo tài khoản của một dòng Excel trên một Bộ, trả về kết quả theo Bộ.
+
+    existing: tài khoản đã có trên Bộ (tra cứu trước khi import), existing_user_id là id của nó
+    (None nếu Bộ không trả về id). Khi đó mode='skip_existing' bỏ qua dòng, mode='update_existing'
+    chỉ cập nhật quá trình công tác (báo lỗi nếu không có id).
+    Quá trình công tác không cập nhật ở đây: kết quả có 'experience_pending' thì bước
+    experience của pipeline (run_experience_cell) làm tiếp.
+    """
+    ministry = ministries_by_id.get(ministry_id)
+
+    if not ministry:
+        return {
+            'ministry_id': ministry_id,
+            'ministry_name': 'Unknown',
+            'status': 'error',
+            'message': 'Không tìm thấy Bộ'
+        }
+
+    ministry_result = {
+        'ministry_id': ministry_id,
+        'ministry_name': ministry['name'],
+        'status': 'pending',
+        'message': ''
+    }
+
+    # Kiểm tra token (tự refresh nếu sắp hết hạn)
+    token_info = get_valid_token(user_id, ministry_id)
+    if token_info is None:
+        ministry_result['status'] = 'no_token'
+        ministry_result['message'] = 'Chưa đồng bộ token'
+        return ministry_result
+
+    access_token = token_info['access_token']
+
+    # Kiểm tra token hết hạn
+    if token_info['expires_at'] < datetime.now():
+        ministry_result['status'] = 'token_expired'
+        ministry_result['message'] = 'Token đã hết hạn'
+        return ministry_result
+
+    # Tài khoản đã tồn tại: không gửi lại request tạo
+    if existing and mode in IMPORT_EXISTING_MODES:
+        ministry_result['existing'] = True
+        if mode == 'update_existing' and account_data.get('agencyParent'):
+            if not existing_user_id:
+                ministry_result['status'] = 'error'
+                ministry_result['message'] = 'Tài khoản đã tồn tại nhưng Bộ không trả về id, không cập nhật được quá trình công tác'
+                return ministry_result
+            ministry_result['user_id'] = existing_user_id
+            ministry_result['message'] = 'Tài khoản đã tồn tại'
+            ministry_result['experience_pending'] = True
+        else:
+            ministry_result['status'] = 'skipped'
+            ministry_result['message'] = 'Tài khoản đã tồn tại, bỏ qua'
+        return ministry_result
+
+    # Tạo tài khoản
+    create_result = create_account_on_ministry(ministry, account_data, access_token, update_experience=False)
+
+    ministry_result['status'] = 'success' if create_result['success'] else 'error'
+    ministry_result['message'] = create_result['message']
+    for key in ('details', 'user_id', 'experience_pending'):
+        if create_result.get(key):
+            ministry_result[key] = create_result[key]
+
+    return ministry_result
+
+def update_account_experience(ministry_id, account_data, user_id, account_id):
+    """Cập nhật quá trình công tác cho tài khoản `account_id` đã có trên Bộ (kiểm tra token như import_account_cell)"""
+    ministry = ministries_by_id.get(ministry_id)
+    if not ministry:
+        return {'success': False, 'message': 'Không tìm thấy Bộ'}
+
+    token_info = get_valid_token(user_id, ministry_id)
+    if token_info is None:
+        return {'success': False, 'message': 'Chưa đồng bộ token'}
+    if token_info['expires_at'] < datetime.now():
+        return {'success': False, 'message': 'Token đã hết hạn'}
+
+    return update_user_experience(ministry, account_id, account_data, token_info['access_token'])
+
+def merge_experience_result(ministry_result, experience_result):
+    """Kết quả của ô sau khi cập nhật quá trình công tác (thông báo như create_account_on_ministry).
+
+    Tài khoản mới tạo vẫn là 'success' khi lỗi experience; lỗi được giữ trong 'experience_error' để thử lại.
+    """
+    result = {k: v for k, v in ministry_result.items() if k not in ('experience_pending', 'experience_error', 'details')}
+    if result.get('existing'):
+        result['status'] = 'success' if experience_result['success'] else 'error'
+        result['message'] = 'Tài khoản đã tồn tại: ' + experience_result['message']
+    elif experience_result['success']:
+        result['message'] = 'Tạo tài khoản và cập nhật quá trình công tác thành công'
+    else:
+        result['message'] = 'Tạo tài khoản thành công nhưng lỗi cập nhật experience: ' + experience_result['message']
+
+    if not experience_result['success']:
+        result['experience_error'] = experience_result['message']
+        if experience_result.get('details'):
+            result['details'] = experience_result['details']
+    return result
+
+# Các bước của pipeline import, chạy đồng thời: dòng N cập nhật quá trình công tác trong lúc dòng N+1 đang được tạo
+IMPORT_STAGES = ('resolve', 'create', 'experience')
+
+def get_import_executor(stage, ministry_id):
+    """Executor của một bước import trên một Bộ (IMPORT_STAGE_WORKERS worker)"""
+    entry = import_executors.get((stage, ministry_id))
+    if entry is None:
+        with import_executors_lock:
+            entry = import_executors.get((stage, ministry_id))
+            if entry is None:
+                executor = ThreadPoolExecutor(max_workers=IMPORT_STAGE_WORKERS, thread_name_prefix=f'import-{stage}-{ministry_id}')
+                entry = import_executors[(stage, ministry_id)] = (executor, threading.BoundedSemaphore(IMPORT_STAGE_QUEUE_SIZE))
+    return entry
+
+def get_import_ministry_slots(ministry_id):
+    """Semaphore giới hạn số request import song song tới một Bộ, dùng chung cho mọi bước"""
+    slots = import_ministry_slots.get(ministry_id)
+    if slots is None:
+        with import_executors_lock:
+            slots = import_ministry_slots.get(ministry_id)
+            if slots is None:
+                ministry = ministries_by_id.get(ministry_id)
+                max_concurrency = ministry.get('max_concurrency', IMPORT_MINISTRY_CONCURRENCY) if ministry else 1
+                slots = import_ministry_slots[ministry_id] = threading.BoundedSemaphore(max_concurrency)
+    return slots
+
+@contextlib.contextmanager
+def import_request_slots(ministry_id):
+    """Giữ slot của Bộ rồi tới slot tổng trong lúc một bước import gọi tới Bộ.
+
+    Luôn lấy theo thứ tự này: thread đang chờ Bộ bận không giữ slot tổng của các Bộ khác.
+    """
+    with get_import_ministry_slots(ministry_id), import_global_slots:
+        yield
+
+def submit_import_stage(stage, ministry_id, fn, *args):
+    """Đưa một việc vào bước `stage` của Bộ; chờ nếu bước đó đã có IMPORT_STAGE_QUEUE_SIZE ô chưa xong.
+
+    Không gọi khi đang giữ import_request_slots (bước sau cần các slot đó để giải phóng hàng đợi).
+    """
+    executor, queue_slots = get_import_executor(stage, ministry_id)
+    queue_slots.acquire()
+
+    def run():
+        try:
+            fn(*args)
+        finally:
+            queue_slots.release()
+
+    try:
+        return submit_with_log_context(executor, run)
+    except BaseException:
+        queue_slots.release()
+        raise
+
+def cleanup_import_jobs():
+    """Xóa các job import đã kết thúc quá IMPORT_JOB_TTL"""
+    now = datetime.now()
+    with import_jobs_lock:
+        expired = [
+            job_id for job_id, job in import_jobs.items()
+            if job['finished_at'] and now - job['finished_at'] > IMPORT_JOB_TTL
+        ]
+        for job_id in expired:
+            del import_jobs[job_id]
+    cleanup_import_journals()
+
+def cleanup_import_journals():
+    """Xóa nhật ký của các job import đã kết thúc và không được ghi thêm quá IMPORT_JOB_TTL (nhật ký chứa dữ liệu
+    cá nhân của file import). Bỏ qua nhật ký đang bị khóa (job đang chạy ở worker nào đó) và nhật ký của job bị
+    gián đoạn (còn dùng để tiếp tục)."""
+    try:
+        names = os.listdir(IMPORT_JOURNAL_DIR)
+    except OSError:
+        return
+    cutoff = time.time() - IMPORT_JOB_TTL.total_seconds()
+    for name in names:
+        job_id, ext = os.path.splitext(name)
+        path = import_journal_path(job_id)
+        if ext != '.jsonl' or path is None:
+            continue
+        try:
+            if os.path.getmtime(path) > cutoff:
+                continue
+            journal = lock_import_journal(job_id)
+            if journal is None:
+                continue
+            with journal:
+                if import_journal_finished(path):
+                    os.remove(path)
+        except OSError:
+            log.warning('Không xóa được nhật ký import', extra={'job_id': job_id}, exc_info=True)
+
+def import_journal_finished(path):
+    """Dòng cuối của nhật ký là bản ghi 'done' (job đã kết thúc), chỉ đọc phần cuối file"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 4096))
+        lines = f.read().splitlines()
+    try:
+        return bool(lines) and json.loads(lines[-1]).get('type') == 'done'
+    except ValueError:
+        return False
+
+def import_journal_path(job_id):
+    """Đường dẫn file nhật ký của job (job_id phải là uuid hex để tránh path traversal)"""
+    if not re.fullmatch(r'[0-9a-f]{32}', job_id or ''):
+        return None
+    return os.path.join(IMPORT_JOURNAL_DIR, f'{job_id}.jsonl')
+
+def lock_import_journal(job_id):
+    """Mở nhật ký để ghi nối tiếp và giữ khóa độc quyền (flock) tới khi đóng file.
+
+    Khóa có hiệu lực giữa các worker gunicorn: trả về None nếu job đang chạy ở nơi khác.
+    """
+    os.makedirs(IMPORT_JOURNAL_DIR, exist_ok=True)
+    journal = open(import_journal_path(job_id), 'a', encoding='utf-8')
+    try:
+        fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        journal.close()
+        return None
+    return journal
+
+def import_journal_running(job_id):
+    """Nhật ký đang bị giữ khóa, tức job đang chạy (ở worker này hoặc worker khác)"""
+    journal = lock_import_journal(job_id)
+    if journal is None:
+        return True
+    journal.close()
+    return False
+
+def open_import_journal(job, file_hash):
+    """Mở và khóa nhật ký của job để ghi nối tiếp; dòng đầu mỗi lần chạy ghi thông tin job.
+
+    Trả về False nếu job đang chạy ở worker khác (không lấy được khóa).
+    """
+    journal = lock_import_journal(job['id'])
+    if journal is None:
+        return False
+
+    # Dòng cuối bị ghi dở khi worker bị tắt: xuống dòng để không dính vào dòng mới
+    partial_line = False
+    path = import_journal_path(job['id'])
+    if os.path.getsize(path) > 0:
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            partial_line = f.read(1) != b'\n'
+
+    job['journal'] = journal
+    if partial_line:
+        job['journal'].write('\n')
+    write_import_journal(job, {
+        'type': 'resume' if job['resumed'] else 'job',
+        'job_id': job['id'],
+        'user_id': job['user_id'],
+        'ministry_ids': job['ministry_ids'],
+        'mode': job['mode'],
+        'file_hash': file_hash
+    })
+    return True
+
+def write_import_journal(job, entry):
+    """Ghi một dòng vào nhật ký và flush ngay để không mất khi worker bị tắt"""
+    journal = job.get('journal')
+    if journal is None:
+        return
+    line = json.dumps({**entry, 'at': datetime.now().isoformat()}, ensure_ascii=False) + '\n'
+    try:
+        with job['journal_lock']:
+            if not journal.closed:
+                journal.write(line)
+                journal.flush()
+    except OSError as e:
+        log.error('Lỗi ghi nhật ký import: %s', e, extra={'job_id': job['id']})
+
+def close_import_journal(job):
+    """Ghi dòng kết thúc và đóng nhật ký (nhả khóa)"""
+    journal = job.get('journal')
+    if journal is None:
+        return
+    write_import_journal(job, {'type': 'done', 'summary': job['summary'], 'error': job['error']})
+    with job['journal_lock']:
+        journal.close()
+
+def load_import_journal(job_id):
+    """Đọc nhật ký của job: thông tin job, kết quả cuối cùng của từng ô (row, ministry_id) và đã kết thúc chưa.
+
+    Trả về None nếu không có nhật ký. Dòng cuối bị ghi dở (worker bị tắt giữa chừng) được bỏ qua.
+    """
+    path = import_journal_path(job_id)
+    if not path or not os.path.exists(path):
+        return None
+
+    journal = {'header': None, 'cells': {}, 'finished': False}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('type') == 'job':
+                journal['header'] = entry
+            elif entry.get('type') == 'resume':
+                journal['finished'] = False
+            elif entry.get('type') == 'cell':
+                journal['cells'][(entry['row'], entry['ministry_id'])] = entry
+            elif entry.get('type') == 'done':
+                journal['finished'] = True
+
+    return journal if journal['header'] else None
+
+def resumed_cell_result(job, account_data, ministry_id):
+    """Kết quả đã ghi trong nhật ký của lần chạy trước cho ô (dòng, Bộ), None nếu ô chưa xong"""
+    entry = job['resumed'].get((account_data['_row'], ministry_id))
+    if not entry or entry['status'] not in ('success', 'skipped') or entry.get('experience_error'):
+        return None
+    result = {k: entry[k] for k in ('ministry_id', 'ministry_name', 'status', 'message', 'user_id') if entry.get(k) is not None}
+    result['message'] = f"{entry.get('message') or ''} (đã xong ở lần chạy trước)"
+    return result
+
+def record_import_cell(job, index, position, ministry_result):
+    """Lưu kết quả một ô (dòng, Bộ) vào job; khi đủ các Bộ của dòng thì cập nhật thống kê"""
+    with import_jobs_lock:
+        result = job['results'][index]
+        result['ministries'][position] = ministry_result
+        job['row_pending'][index] -= 1
+
+        if job['row_pending'][index] > 0:
+            return
+
+        if index not in job['completed_set']:
+            job['completed_set'].add(index)
+            job['completed'].append(index)
+        job['changes'].append(index)
+        count_import_row(job['summary'], result)
+        job['summary']['pending_rows'] -= 1
+
+        finish_import_job_if_done(job)
+        import_jobs_changed.notify_all()
+
+def count_import_row(summary, result, sign=1):
+    """Cộng (sign=-1: trừ) kết quả các Bộ của một dòng đã xong vào thống kê của job"""
+    statuses = [m['status'] for m in result['ministries']]
+    summary['success_count'] += sign * statuses.count('success')
+    summary['skipped_count'] += sign * statuses.count('skipped')
+    summary['error_count'] += sign * sum(1 for st in statuses if st in ['error', 'no_token', 'token_expired'])
+
+    if all(st in ('success', 'skipped') for st in statuses):
+        summary['done_rows'] += sign
+    else:
+        summary['failed_rows'] += sign
+
+def finish_import_job_if_done(job):
+    """Đánh dấu job hoàn tất khi đã đọc hết file và không còn dòng chờ (gọi khi đang giữ import_jobs_lock)"""
+    if not job['reading'] and job['summary']['pending_rows'] == 0 and job['status'] != 'done':
+        job['status'] = 'done'
+        job['finished_at'] = datetime.now()
+        close_import_journal(job)
+
+def run_import_cell(job, index, position, ministry_id, account_data):
+    """Bước create của pipeline import: tạo tài khoản của một dòng trên một Bộ.
+
+    Cập nhật quá trình công tác được chuyển sang bước experience để không chặn việc tạo dòng tiếp theo.
+    """
+    # Ô đã xong ở lần chạy trước (tiếp tục từ nhật ký): không gửi lại request
+    ministry_result = resumed_cell_result(job, account_data, ministry_id)
+    if ministry_result:
+        record_import_cell(job, index, position, ministry_result)
+        return
+
+    with import_request_slots(ministry_id):
+        if job['status'] == 'queued':
+            job['status'] = 'running'
+        try:
+            mode = job['mode']
+            existing = (account_data['username'], ministry_id) in job['existing']
+            existing_user_id = job['existing'].get((account_data['username'], ministry_id))
+            resumed = job['resumed'].get((account_data['_row'], ministry_id))
+            if resumed and resumed.get('user_id'):
+                # Đã tạo tài khoản ở lần chạy trước nhưng chưa cập nhật được quá trình công tác
+                mode, existing, existing_user_id = 'update_existing', True, resumed['user_id']
+            ministry_result = import_account_cell(ministry_id, account_data, job['user_id'], mode, existing, existing_user_id)
+        except Exception as e:
+            ministry_result = {
+                'ministry_id': ministry_id,
+                'ministry_name': '',
+                'status': 'error',
+                'message': f'Lỗi: {str(e)[:50]}'
+            }
+
+    if ministry_result.get('experience_pending'):
+        if not ministry_result.get('existing'):
+            # Ghi nhận tài khoản đã tạo: bị gián đoạn trước bước experience thì lần tiếp tục không tạo lại
+            write_import_cell_journal(job, account_data, {**ministry_result, 'experience_error': 'Chưa cập nhật quá trình công tác'})
+        submit_import_stage('experience', ministry_id, run_experience_cell, job, index, position, ministry_id, account_data, ministry_result)
+        return
+
+    finish_import_cell(job, index, position, account_data, ministry_result)
+
+def run_experience_cell(job, index, position, ministry_id, account_data, ministry_result):
+    """Bước experience của pipeline import: cập nhật quá trình công tác cho tài khoản vừa tạo (hoặc đã tồn tại)"""
+    with import_request_slots(ministry_id):
+        try:
+            experience_result = update_account_experience(ministry_id, account_data, job['user_id'], ministry_result['user_id'])
+        except Exception as e:
+            experience_result = {'success': False, 'message': f'Lỗi: {str(e)[:50]}'}
+
+    finish_import_cell(job, index, position, account_data, merge_experience_result(ministry_result, experience_result))
+
+def resolve_import_agencies(job, ministry_id, agency_parent, agency_dept):
+    """Bước resolve của pipeline import: tra cứu trước agency của các dòng sắp tạo để bước experience lấy từ agency_cache"""
+    ministry = ministries_by_id.get(ministry_id)
+    token_info = get_valid_token(job['user_id'], ministry_id)
+    if not ministry or token_info is None or token_info['expires_at'] < datetime.now():
+        return
+
+    with import_request_slots(ministry_id):
+        try:
+            parent_id, _ = agency_ref(get_agency_tree(ministry, agency_parent, token_info['access_token']))
+            if agency_dept:
+                get_agency_tree(ministry, agency_dept, token_info['access_token'], parent_id or None)
+        except AmbiguousAgencyError:
+            # Bước experience sẽ báo lỗi trùng tên cho dòng này
+            pass
+
+def write_import_cell_journal(job, account_data, ministry_result):
+    """Ghi kết quả một ô (dòng, Bộ) vào nhật ký của job"""
+    write_import_journal(job, {
+        'type': 'cell',
+        'row': account_data['_row'],
+        'username': account_data['username'],
+        **{k: ministry_result.get(k) for k in ('ministry_id', 'ministry_name', 'status', 'message', 'user_id', 'experience_error')}
+    })
+
+def finish_import_cell(job, index, position, account_data, ministry_result):
+    """Ô (dòng, Bộ) đã qua hết các bước: ghi metrics, nhật ký và lưu kết quả vào job"""
+    if METRICS_ENABLED:
+        metrics.inc('import_cells_total', ministry=ministry_result['ministry_id'], status=ministry_result['status'])
+    log.info('Import cell', extra={'job_id': job['id'], 'row': account_data['_row'], 'ministry': ministry_result['ministry_id'],
+                                   'status': ministry_result['status'], 'sampled': True})
+    write_import_cell_journal(job, account_data, ministry_result)
+    record_import_cell(job, index, position, ministry_result)
+
+def submit_import_job(user_id, rows, selected_ministry_ids, mode='create', file_hash=None, resume_job_id=None, resumed=None):
+    """Tạo job import; các dòng được đọc dần từ `rows` ở thread nền và đưa ngay vào worker pool.
+
+    mode khác 'create': tra cứu trước tất cả username trên các Bộ được chọn để bỏ qua
+    (hoặc chỉ cập nhật quá trình công tác) các tài khoản đã tồn tại.
+    resume_job_id / resumed: tiếp tục job bị gián đoạn, bỏ qua các ô đã xong trong nhật ký.
+    Trả về None nếu job đó đang chạy ở worker khác.
+    """
+    cleanup_import_jobs()
+
+    job = {
+        'id': resume_job_id or uuid.uuid4().hex,
+        'user_id': user_id,
+        'status': 'queued',
+        'reading': True,  # Còn đang đọc file
+        'error': None,
+        'created_at': datetime.now(),
+        'finished_at': None,
+        'ministry_ids': selected_ministry_ids,
+        'mode': mode,
+        'existing': {},  # {(username, ministry_id): id tài khoản đã có, None nếu Bộ không trả về id}
+        'resumed': resumed or {},  # {(row, ministry_id): kết quả trong nhật ký lần chạy trước}
+        'agencies': set(),  # {(ministry_id, agencyParent, agencyDepartment)} cặp agency đã đưa vào bước resolve
+        'journal': None,
+        'journal_lock': threading.Lock(),
+        'results': [],
+        'row_pending': [],  # Số Bộ còn chờ của từng dòng
+        'completed': [],  # Thứ tự index các dòng đã xử lý xong, mỗi dòng một lần
+        'completed_set': set(),
+        # Index dòng theo thứ tự mỗi lần xong (dòng thử lại xuất hiện lại); since / next là vị trí trong danh sách này
+        'changes': [],
+        'summary': {
+            'total_accounts': 0,
+            'total_operations': 0,
+            'success_count': 0,
+            'skipped_count': 0,
+            'error_count': 0,
+            'done_rows': 0,
+            'failed_rows': 0,
+            'pending_rows': 0
+        }
+    }
+
+    if not open_import_journal(job, file_hash):
+        return None
+
+    with import_jobs_lock:
+        import_jobs[job['id']] = job
+
+    start_token_refresher()
+    threading.Thread(target=contextvars.copy_context().run, args=(feed_import_job, job, rows), daemon=True,
+                     name=f"import-feed-{job['id'][:8]}").start()
+
+    return job
+
+def find_existing_accounts(user_id, rows, selected_ministry_ids):
+    """Tra cứu hàng loạt username của các dòng trên các Bộ, trả về {(username, ministry_id): id tài khoản hoặc None}"""
+    usernames = list(dict.fromkeys(account_data['username'] for account_data in rows if account_data['username']))
+    ministry_list = [m for m in ministries if m['id'] in selected_ministry_ids]
+
+    existing = {}
+    for username, results in bulk_lookup(user_id, usernames, ministry_list, exact=True).items():
+        for ministry_id, result in results.items():
+            if result.get('found'):
+                existing[(username, ministry_id)] = result['accounts'][0].get('id')
+    return existing
+
+def iter_chunks(rows, size):
+    """Chia các dòng thành từng đợt `size` dòng (đọc lười)"""
+    chunk = []
+    for account_data in rows:
+        chunk.append(account_data)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def timed_rows(rows):
+    """Đo thời gian đọc (parse Excel/CSV) từng dòng vào import_stage_seconds{stage="parse"}"""
+    rows = iter(rows)
+    try:
+        while True:
+            started = time.monotonic()
+            try:
+                account_data = next(rows)
+            except StopIteration:
+                return
+            metrics.observe('import_stage_seconds', time.monotonic() - started, stage='parse')
+            yield account_data
+    finally:
+        if hasattr(rows, 'close'):
+            rows.close()
+
+def submit_import_agencies(job, ministry_id, account_data):
+    """Đưa các agency của dòng (chưa tra cứu trong job) vào bước resolve, trước khi dòng được tạo"""
+    if not account_data.get('agencyParent'):
+        return
+    if job['mode'] == 'skip_existing' and (account_data['username'], ministry_id) in job['existing']:
+        return
+    key = (ministry_id, account_data['agencyParent'], account_data.get('agencyDepartment') or '')
+    if key not in job['agencies']:
+        job['agencies'].add(key)
+        submit_import_stage('resolve', ministry_id, resolve_import_agencies, job, *key)
+
+def feed_import_job(job, rows):
+    """Đọc từng dòng và đưa các ô (dòng, Bộ) vào executor ngay khi đọc được"""
+    selected_ministry_ids = job['ministry_ids']
+    try:
+        if METRICS_ENABLED:
+            rows = timed_rows(rows)
+
+        if job['mode'] in IMPORT_EXISTING_MODES:
+            rows = checked_existing_rows(job, rows)
+
+        for account_data in rows:
+            with import_jobs_lock:
+                index = len(job['results'])
+                job['results'].append({
+                    'row': account_data['_row'],
+                    'account': account_data,
+                    'ministries': [None] * len(selected_ministry_ids)
+                })
+                job['row_pending'].append(len(selected_ministry_ids))
+                job['summary']['total_accounts'] += 1
+                job['summary']['total_operations'] += len(selected_ministry_ids)
+                job['summary']['pending_rows'] += 1
+
+            # Các ô (dòng, Bộ) chạy song song; thứ tự kết quả cố định theo vị trí của Bộ trong dòng
+            for position, ministry_id in enumerate(selected_ministry_ids):
+                submit_import_agencies(job, ministry_id, account_data)
+                submit_import_stage('create', ministry_id, run_import_cell, job, index, position, ministry_id, account_data)
+    except Exception as e:
+        job['error'] = f'Lỗi khi đọc file Excel: {str(e)}'
+    finally:
+        with import_jobs_lock:
+            job['reading'] = False
+            finish_import_job_if_done(job)
+            import_jobs_changed.notify_all()
+
+def checked_existing_rows(job, rows):
+    """Chế độ skip_existing / update_existing: đọc từng đợt IMPORT_EXISTING_CHUNK_ROWS dòng, tra cứu tài khoản
+    đã tồn tại của đợt đó vào job['existing'] rồi mới trả các dòng cho bước tạo"""
+    for chunk in iter_chunks(rows, IMPORT_EXISTING_CHUNK_ROWS):
+        job['status'] = 'checking'
+        job['existing'].update(find_existing_accounts(job['user_id'], chunk, job['ministry_ids']))
+        job['status'] = 'running'
+        yield from chunk
+
+def cell_to_str(val):
+    """Lấy giá trị string từ ô Excel/CSV, xử lý ô trống và số"""
+    if val is None:
+        return ''
+    # Số nguyên lưu dạng float (ví dụ 6201004050.0) chuyển về '6201004050'
+    if isinstance(val, float) and val.is_integer():
+        return str(int(val))
+    if isinstance(val, datetime):
+        return val.date().isoformat() if val.time() == datetime.min.time() else val.isoformat()
+    return str(val).strip()
+
+# Chế độ import có tra cứu trước tài khoản đã tồn tại
+IMPORT_EXISTING_MODES = ('skip_existing', 'update_existing')
+
+# Các cột bắt buộc trong file Excel và các cột bắt buộc phải có giá trị
+IMPORT_REQUIRED_COLUMNS = ['fullname', 'phoneNumber', 'email', 'username', 'password']
+IMPORT_REQUIRED_VALUES = ['fullname', 'username', 'password']
+
+def iter_account_rows(header, rows, cleanup_path=None):
+    """Sinh lần lượt account_data từ các dòng dữ liệu (đọc lười, không nạp cả file vào bộ nhớ)"""
+    columns = {name: i for i, name in enumerate(header)}
+
+    def get(values, name):
+        i = columns.get(name)
+        return cell_to_str(values[i]) if i is not None and i < len(values) else ''
+
+    try:
+        for row_number, values in rows:
+            if not any(v not in (None, '') for v in values):
+                continue
+            yield {
+                '_row': row_number,
+                'fullname': get(values, 'fullname'),
+                'phoneNumber': get(values, 'phoneNumber'),
+                'email': get(values, 'email'),
+                'username': get(values, 'username'),
+                'password': get(values, 'password'),
+                'agencyParent': get(values, 'agencyParent'),
+                'agencyDepartment': get(values, 'agencyDepartment'),
+                'position': get(values, 'position')
+            }
+    finally:
+        rows.close()
+        if cleanup_path:
+            try:
+                os.remove(cleanup_path)
+            except OSError:
+                pass
+
+def discard_account_rows(rows):
+    """Bỏ file đã tải lên mà không import: generator chưa chạy thì close() không vào finally dọn file tạm"""
+    next(rows, None)
+    rows.close()
+
+def open_account_file(path, filename):
+    """Mở file Excel (read-only, streaming) hoặc CSV; trả về (header, iterator (số dòng, giá trị))"""
+    if filename.lower().endswith('.csv'):
+        f = open(path, encoding='utf-8-sig', newline='')
+        reader = csv.reader(f)
+
+        def csv_rows():
+            with f:
+                for row_number, values in enumerate(reader, start=2):
+                    yield row_number, values
+
+        header = [h.strip() for h in next(reader, [])]
+        return header, csv_rows()
+
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    sheet = workbook.worksheets[0]
+    sheet_rows = sheet.iter_rows(values_only=True)
+
+    def excel_rows():
+        try:
+            for row_number, values in enumerate(sheet_rows, start=2):
+                yield row_number, values
+        finally:
+            workbook.close()
+
+    header = [cell_to_str(h) for h in next(sheet_rows, ())]
+    return header, excel_rows()
+
+def read_import_request():
+    """Đọc danh sách Bộ và mở file Excel/CSV từ request.
+
+    Trả về (rows, selected_ministry_ids, file_hash, error) với rows là iterator account_data
+    đọc dần từ file tạm và file_hash là SHA-256 của file (dùng khi tiếp tục job import).
+    """
     # Kiểm tra file
     if 'file' not in request.files:
-        return jsonify({'error': 'Vui lòng chọn file Excel'})
+        return None, None, None, 'Vui lòng chọn file Excel'
 
     file = request.files['file']
 
     if file.filename == '':
-        return jsonify({'error': 'Vui lòng chọn file Excel'})
+        return None, None, None, 'Vui lòng chọn file Excel'
 
-    if not file.filename.endswith(('.xlsx', '.xls')):
-        return jsonify({'error': 'File phải có định dạng .xlsx hoặc .xls'})
+    if not file.filename.lower().endswith(('.xlsx', '.xls', '.csv')):
+        return None, None, None, 'File phải có định dạng .xlsx, .xls hoặc .csv'
 
     # Lấy danh sách bộ được chọn
     selected_ministries = request.form.get('ministries', '')
 
     if not selected_ministries:
-        return jsonify({'error': 'Vui lòng chọn ít nhất một Bộ'})
+        return None, None, None, 'Vui lòng chọn ít nhất một Bộ'
 
     try:
         selected_ministry_ids = [int(x.strip()) for x in selected_ministries.split(',')]
     except:
-        return jsonify({'error': 'Định dạng Bộ không hợp lệ'})
+        return None, None, None, 'Định dạng Bộ không hợp lệ'
+
+    # Lưu file ra đĩa để đọc dần ở thread nền sau khi request kết thúc
+    fd, path = tempfile.mkstemp(prefix='import-', suffix=os.path.splitext(file.filename)[1])
+    file_hash = hashlib.sha256()
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in iter(lambda: file.stream.read(64 * 1024), b''):
+            file_hash.update(chunk)
+            f.write(chunk)
 
-    # Đọc file Excel
     try:
-        # Đọc Excel và chuyển tất cả các cột thành string để giữ nguyên định dạng
-        df = pd.read_excel(file, engine='openpyxl', dtype=str)
+        header, rows = open_account_file(path, file.filename)
 
         # Kiểm tra các cột bắt buộc
-        required_columns = ['fullname', 'phoneNumber', 'email', 'username', 'password']
-        missing_columns = [col for col in required_columns if col not in df.columns]
+        missing_columns = [col for col in IMPORT_REQUIRED_COLUMNS if col not in header]
 
         if missing_columns:
-            return jsonify({
-                'error': f'Thiếu các cột bắt buộc: {", ".join(missing_columns)}'
-            })
+            rows.close()
+            os.remove(path)
+            return None, None, None, f'Thiếu các cột bắt buộc: {", ".join(missing_columns)}'
+    except Exception as e:
+        os.remove(path)
+        return None, None, None, f'Lỗi khi đọc file Excel: {str(e)}'
+
+    return iter_account_rows(header, rows, cleanup_path=path), selected_ministry_ids, file_hash.hexdigest(), None
+
+def preflight_import(user_id, rows, selected_ministry_ids, job=None):
+    """Kiểm tra trước khi import (không ghi gì lên các Bộ).
+
+    Đọc file một lượt (không nạp cả file vào bộ nhớ) để kiểm tra dữ liệu từng dòng, rồi kiểm tra token
+    của các Bộ cho cả lượt import và tra cứu mỗi agency khác nhau đúng một lần cho mỗi Bộ trên
+    preflight_executor. Agency chưa tra cứu được (quá PREFLIGHT_AGENCY_TIMEOUT hoặc vượt
+    PREFLIGHT_MAX_AGENCY_LOOKUPS) chỉ được báo cảnh báo. `job`: cập nhật job['checked_rows'] trong lúc đọc.
+    """
+    issues = []
+
+    def add_issue(level, message, row=None, ministry_id=None, field=None):
+        issues.append({'level': level, 'row': row, 'ministry_id': ministry_id, 'field': field, 'message': message})
+
+    # Dữ liệu từng dòng; chỉ giữ lại username và cặp agency của các dòng
+    seen_usernames = {}
+    agency_rows = {}  # {(agencyParent, agencyDepartment): [số dòng]}
+    total_rows = 0
+    for account_data in rows:
+        total_rows += 1
+        if job is not None:
+            job['checked_rows'] = total_rows
+
+        for field in IMPORT_REQUIRED_VALUES:
+            if not account_data[field]:
+                add_issue('error', f'Thiếu giá trị cột {field}', account_data['_row'], field=field)
+
+        username = account_data['username']
+        if username:
+            if username in seen_usernames:
+                add_issue('error', f'Trùng username với dòng {seen_usernames[username]}', account_data['_row'], field='username')
+            else:
+                seen_usernames[username] = account_data['_row']
+
+        if account_data['position'] and account_data['position'] not in KNOWN_POSITIONS:
+            add_issue('warning', f'Chức vụ "{account_data["position"]}" không có trong danh mục, sẽ dùng "Chuyên viên"',
+                      account_data['_row'], field='position')
+
+        if account_data['agencyDepartment'] and not account_data['agencyParent']:
+            add_issue('warning', 'Có agencyDepartment nhưng thiếu agencyParent, sẽ không cập nhật quá trình công tác',
+                      account_data['_row'], field='agencyParent')
+
+        if account_data['agencyParent']:
+            agency_rows.setdefault((account_data['agencyParent'], account_data['agencyDepartment']), []).append(account_data['_row'])
+
+    # Token của từng Bộ phải còn hạn (hoặc refresh được) cho tới khi import xong (ước lượng)
+    user_tokens = {}
+    token_report = []
+    valid_ministries = []
+    for ministry_id in selected_ministry_ids:
+        ministry = ministries_by_id.get(ministry_id)
+        entry = {'ministry_id': ministry_id, 'ministry_name': ministry['name'] if ministry else 'Unknown'}
+        token_info = get_valid_token(user_id, ministry_id) if ministry else None
+
+        if not ministry:
+            entry.update(status='error', message='Không tìm thấy Bộ')
+        elif token_info is None:
+            entry.update(status='no_token', message='Chưa đồng bộ token')
+        else:
+            user_tokens[ministry_id] = token_info
+            expires_at = token_info['expires_at']
+            concurrency = ministry.get('max_concurrency', IMPORT_MINISTRY_CONCURRENCY)
+            estimated_end = datetime.now() + timedelta(seconds=total_rows * IMPORT_ESTIMATED_SECONDS_PER_ROW / concurrency)
+            if expires_at < datetime.now():
+                entry.update(status='token_expired', message='Token đã hết hạn')
+            elif expires_at < estimated_end and not token_info.get('refresh_token'):
+                entry.update(status='expiring', message=f'Token hết hạn lúc {expires_at:%H:%M}, có thể trước khi import xong')
+                valid_ministries.append(ministry)
+            else:
+                entry.update(status='success', message='Token hợp lệ')
+                valid_ministries.append(ministry)
+
+        if entry['status'] == 'expiring':
+            add_issue('warning', entry['message'], ministry_id=ministry_id)
+        elif entry['status'] != 'success':
+            add_issue('error', entry['message'], ministry_id=ministry_id)
+        token_report.append(entry)
+
+    # Tra cứu mỗi agency khác nhau một lần cho mỗi Bộ (song song, có giới hạn số lượng và thời gian):
+    # agency cha trước, rồi agencyDepartment trong cây con của agency cha
+    deadline = time.monotonic() + PREFLIGHT_AGENCY_TIMEOUT
+    submitted = 0
+
+    def lookup_agencies(calls):
+        """{key: (ministry, keyword, access_token, parent_id)} -> {key: agency | None | AmbiguousAgencyError} (bỏ qua key chưa tra được)"""
+        nonlocal submitted
+        futures = {}
+        for key, args in calls.items():
+            if submitted >= PREFLIGHT_MAX_AGENCY_LOOKUPS:
+                break
+            submitted += 1
+            futures[key] = submit_with_log_context(preflight_executor, get_agency_tree, *args)
+
+        done, not_done = wait(futures.values(), timeout=max(0, deadline - time.monotonic()))
+        for future in not_done:
+            future.cancel()
+
+        results = {}
+        for key, future in futures.items():
+            if future in done and not future.cancelled():
+                try:
+                    results[key] = future.result()
+                except AmbiguousAgencyError as e:
+                    results[key] = e
+        return results
+
+    parent_calls, dept_calls = {}, {}
+    for ministry in valid_ministries:
+        access_token = user_tokens[ministry['id']]['access_token']
+        for agency_parent in sorted({agency_parent for agency_parent, _ in agency_rows}):
+            parent_calls[(ministry['id'], agency_parent)] = (ministry, agency_parent, access_token, None)
+    parents = lookup_agencies(parent_calls)
+
+    for (agency_parent, agency_dept) in sorted(agency_rows):
+        for ministry in valid_ministries:
+            parent = parents.get((ministry['id'], agency_parent))
+            if not agency_dept or (ministry['id'], agency_parent) not in parents or isinstance(parent, AmbiguousAgencyError):
+                continue
+            access_token = user_tokens[ministry['id']]['access_token']
+            dept_calls[(ministry['id'], agency_parent, agency_dept)] = (ministry, agency_dept, access_token, agency_ref(parent)[0] or None)
+    depts = lookup_agencies(dept_calls)
+
+    def report_entry(ministry_id, keyword, agency, agency_parent=None):
+        ambiguous = isinstance(agency, AmbiguousAgencyError)
+        found = agency is not None and not ambiguous
+        return {
+            'ministry_id': ministry_id,
+            'keyword': keyword,
+            'agency_parent': agency_parent,
+            'found': found,
+            'ambiguous': ambiguous,
+            'id': agency.get('id') if found else None,
+            'name': agency.get('name') if found else None
+        }
 
-        # Lấy token của user
-        user_id = session['user_id']
-        user_tokens = get_user_tokens(user_id)
-
-        results = []
-
-        # Duyệt qua từng dòng trong Excel
-        for index, row in df.iterrows():
-            # Helper function để xử lý giá trị từ Excel
-            def get_str_value(val):
-                """Lấy giá trị string từ Excel, xử lý NaN và số"""
-                if pd.isna(val):
-                    return ''
-                val_str = str(val).strip()
-                # Nếu là số (ví dụ 6201004050.0), chuyển về string và bỏ .0
-                if val_str.endswith('.0'):
-                    val_str = val_str[:-2]
-                return val_str
-
-            account_data = {
-                'fullname': get_str_value(row['fullname']),
-                'phoneNumber': get_str_value(row['phoneNumber']),
-                'email': get_str_value(row['email']),
-                'username': get_str_value(row['username']),
-                'password': get_str_value(row['password']),
-                'agencyParent': get_str_value(row['agencyParent']) if 'agencyParent' in df.columns else '',
-                'agencyDepartment': get_str_value(row['agencyDepartment']) if 'agencyDepartment' in df.columns else '',
-                'position': get_str_value(row['position']) if 'position' in df.columns else ''
-            }
+    agency_report = ([report_entry(ministry_id, keyword, agency) for (ministry_id, keyword), agency in parents.items()]
+                     + [report_entry(ministry_id, keyword, agency, agency_parent)
+                        for (ministry_id, agency_parent, keyword), agency in depts.items()])
+
+    for ministry in valid_ministries:
+        unchecked = (sum(1 for key in parent_calls if key[0] == ministry['id'] and key not in parents)
+                     + sum(1 for (agency_parent, agency_dept) in agency_rows
+                           if agency_dept and (ministry['id'], agency_parent, agency_dept) not in depts
+                           and not isinstance(parents.get((ministry['id'], agency_parent)), AmbiguousAgencyError)))
+        if unchecked:
+            add_issue('warning', f'Chưa kiểm tra được {unchecked} agency (quá thời gian hoặc quá số lượng tra cứu), '
+                      'các agency này sẽ được tra cứu khi import', ministry_id=ministry['id'])
+
+        agency_issues = []
+        for (agency_parent, agency_dept), row_numbers in agency_rows.items():
+            parent_key, dept_key = (ministry['id'], agency_parent), (ministry['id'], agency_parent, agency_dept)
+            if parent_key not in parents:
+                continue
+            parent, dept = parents[parent_key], depts.get(dept_key)
+            if isinstance(parent, AmbiguousAgencyError):
+                issue = {'level': 'error', 'field': 'agencyParent', 'message': str(parent)}
+            elif agency_dept and dept_key not in depts:
+                continue
+            elif isinstance(dept, AmbiguousAgencyError):
+                issue = {'level': 'error', 'field': 'agencyDepartment', 'message': str(dept)}
+            elif dept is None and parent is None:
+                issue = {'level': 'error', 'field': 'agencyParent', 'message': f'Không tìm thấy agency "{agency_parent}"'}
+            elif agency_dept and dept is None:
+                issue = {'level': 'warning', 'field': 'agencyDepartment',
+                         'message': f'Không tìm thấy agencyDepartment "{agency_dept}" trong "{agency_parent}"'}
+            else:
+                continue
+            agency_issues.extend({**issue, 'row': row, 'ministry_id': ministry['id']} for row in row_numbers)
+        issues.extend(sorted(agency_issues, key=lambda issue: issue['row']))
+
+    error_count = sum(1 for issue in issues if issue['level'] == 'error')
+    return {
+        'success': True,
+        'ok': error_count == 0,
+        'summary': {
+            'total_rows': total_rows,
+            'total_operations': total_rows * len(selected_ministry_ids),
+            'error_count': error_count,
+            'warning_count': len(issues) - error_count
+        },
+        'tokens': token_report,
+        'agencies': agency_report,
+        'issues': issues
+    }
 
-            result = {
-                'row': index + 2,  # +2 vì Excel bắt đầu từ hàng 1 và header là hàng 1
-                'account': account_data,
-                'ministries': []
-            }
+def run_preflight_job(job, rows, selected_ministry_ids, state_file):
+    """Thread nền: chạy kiểm tra trước import của job, xong thì ghi báo cáo ra file trạng thái cho các worker khác"""
+    try:
+        job['report'] = preflight_import(job['user_id'], rows, selected_ministry_ids, job)
+    except Exception as e:
+        log.exception('Lỗi kiểm tra trước import', extra={'job_id': job['id']})
+        job['error'] = f'Lỗi khi kiểm tra file: {str(e)[:100]}'
+    finally:
+        try:
+            save_job_state(state_file, {**{key: job[key] for key in ('id', 'user_id', 'error', 'checked_rows', 'report')},
+                                        'status': 'done'})
+        except Exception:
+            log.exception('Lỗi ghi trạng thái job kiểm tra trước import', extra={'job_id': job['id']})
+        with import_jobs_lock:
+            job['status'] = 'done'
+            job['finished_at'] = datetime.now()
+
+@app.route('/import-accounts/preflight', methods=['POST'])
+@login_required
+def preflight_import_accounts():
+    """Tạo job kiểm tra file Excel trước khi import (chạy nền); theo dõi qua /import-accounts/preflight/<job_id>"""
+    rows, selected_ministry_ids, _, error = read_import_request()
+
+    if error:
+        return jsonify({'error': error})
+
+    cleanup_finished_jobs(preflight_jobs, 'preflight')
+    job = {
+        'id': uuid.uuid4().hex,
+        'user_id': session['user_id'],
+        'status': 'running',
+        'error': None,
+        'created_at': datetime.now(),
+        'finished_at': None,
+        'checked_rows': 0,
+        'report': None
+    }
+    state_file = lock_job_state('preflight', job['id'])
+    with import_jobs_lock:
+        preflight_jobs[job['id']] = job
 
-            # Tạo tài khoản trên từng bộ được chọn
-            for ministry_id in selected_ministry_ids:
-                ministry = next((m for m in ministries if m['id'] == ministry_id), None)
-
-                if not ministry:
-                    result['ministries'].append({
-                        'ministry_id': ministry_id,
-                        'ministry_name': 'Unknown',
-                        'status': 'error',
-                        'message': 'Không tìm thấy Bộ'
-                    })
-                    continue
+    threading.Thread(target=contextvars.copy_context().run, args=(run_preflight_job, job, rows, selected_ministry_ids, state_file),
+                     daemon=True, name=f"preflight-{job['id'][:8]}").start()
 
-                ministry_result = {
-                    'ministry_id': ministry_id,
-                    'ministry_name': ministry['name'],
-                    'status': 'pending',
-                    'message': ''
-                }
+    return jsonify({'success': True, 'job_id': job['id']})
 
-                # Kiểm tra token
-                if ministry_id not in user_tokens:
-                    ministry_result['status'] = 'no_token'
-                    ministry_result['message'] = 'Chưa đồng bộ token'
-                    result['ministries'].append(ministry_result)
-                    continue
+@app.route('/import-accounts/preflight/<job_id>')
+@login_required
+def get_preflight_job(job_id):
+    """Tiến độ của job kiểm tra trước import; xong thì trả báo cáo lỗi / cảnh báo"""
+    job = preflight_jobs.get(job_id) or load_job_state('preflight', job_id)
+    if job == 'running':
+        return job_running_elsewhere()
+    if not job or job['user_id'] != session['user_id']:
+        return jsonify({'error': 'Không tìm thấy job kiểm tra'}), 404
 
-                access_token = user_tokens[ministry_id]['access_token']
+    if job['status'] != 'done' or job['error']:
+        return jsonify({'success': job['error'] is None, 'job_id': job['id'], 'status': job['status'],
+                        'error': job['error'], 'checked_rows': job['checked_rows']})
 
-                # Kiểm tra token hết hạn
-                if user_tokens[ministry_id]['expires_at'] < datetime.now():
-                    ministry_result['status'] = 'token_expired'
-                    ministry_result['message'] = 'Token đã hết hạn'
-                    result['ministries'].append(ministry_result)
-                    continue
+    return jsonify({**job['report'], 'job_id': job['id'], 'status': job['status']})
+
+@app.route('/import-accounts', methods=['POST'])
+@login_required
+def import_accounts():
+    """Import tài khoản từ file Excel (chạy nền, trả về job_id để theo dõi tiến độ).
+
+    Có resume_job_id: tiếp tục job bị gián đoạn từ nhật ký, file tải lên phải giống hệt file lần trước.
+    """
+    mode = request.form.get('mode', 'create')
+    if mode not in ('create',) + IMPORT_EXISTING_MODES:
+        return jsonify({'error': 'Chế độ import không hợp lệ'})
+
+    rows, selected_ministry_ids, file_hash, error = read_import_request()
+
+    if error:
+        return jsonify({'error': error})
+
+    resume_job_id = request.form.get('resume_job_id')
+    if resume_job_id:
+        journal = load_import_journal(resume_job_id)
+        error = None
+        if not journal or journal['header']['user_id'] != session['user_id']:
+            error = 'Không tìm thấy nhật ký của job import'
+        elif journal['header']['file_hash'] != file_hash:
+            error = 'File không giống file của lần import trước'
+        if error:
+            discard_account_rows(rows)
+            return jsonify({'error': error})
+
+        # Tiếp tục với đúng các Bộ và chế độ của lần chạy trước; nhật ký đang bị khóa thì job vẫn đang chạy
+        header = journal['header']
+        job = submit_import_job(session['user_id'], rows, header['ministry_ids'], header['mode'],
+                                file_hash, resume_job_id, journal['cells'])
+        if job is None:
+            discard_account_rows(rows)
+            return jsonify({'error': 'Job import đang chạy'})
+    else:
+        job = submit_import_job(session['user_id'], rows, selected_ministry_ids, mode, file_hash)
+
+    return jsonify({
+        'success': True,
+        'job_id': job['id'],
+        'status': job['status'],
+        'summary': job['summary']
+    })
+
+def changed_import_rows(job, since):
+    """Index các dòng xong (hoặc xong lại) từ vị trí `since` của job['changes'], mỗi dòng một lần (gọi khi giữ import_jobs_lock)"""
+    if since == 0:
+        return list(job['completed'])
+    return list(dict.fromkeys(job['changes'][since:]))
+
+def serialize_import_job(job, since=0):
+    """Chuyển job thành dict JSON; chỉ trả về kết quả các dòng thay đổi từ vị trí `since`"""
+    with import_jobs_lock:
+        completed = changed_import_rows(job, since)
+        return {
+            'success': True,
+            'job_id': job['id'],
+            'status': job['status'],
+            'reading': job['reading'],
+            'error': job['error'],
+            'created_at': job['created_at'].isoformat(),
+            'finished_at': job['finished_at'].isoformat() if job['finished_at'] else None,
+            'ministry_ids': job['ministry_ids'],
+            'mode': job['mode'],
+            'summary': dict(job['summary']),
+            'results': [public_import_result(job['results'][index]) for index in completed],
+            'next': len(job['changes'])
+        }
+
+def public_import_result(result):
+    """Bỏ các trường nội bộ (mật khẩu, số dòng) khỏi kết quả trả về client"""
+    account = {k: v for k, v in result['account'].items() if k != 'password' and not k.startswith('_')}
+    return {**result, 'account': account}
 
-                # Tạo tài khoản
-                create_result = create_account_on_ministry(ministry, account_data, access_token)
+@app.route('/import-jobs')
+@login_required
+def list_import_jobs():
+    """Danh sách job import của user hiện tại"""
+    user_id = session['user_id']
+    with import_jobs_lock:
+        jobs = [job for job in import_jobs.values() if job['user_id'] == user_id]
+    jobs.sort(key=lambda job: job['created_at'], reverse=True)
+
+    return jsonify({'jobs': [{
+        'job_id': job['id'],
+        'status': job['status'],
+        'created_at': job['created_at'].isoformat(),
+        'summary': dict(job['summary'])
+    } for job in jobs]})
+
+def import_job_not_found(job_id):
+    """Job không có trong bộ nhớ của worker này.
+
+    Nhật ký đang bị khóa: job đang chạy ở worker khác, client hỏi lại sau. Nhật ký chưa kết thúc và
+    không bị khóa (worker đã khởi động lại...): báo có thể tiếp tục.
+    """
+    journal = load_import_journal(job_id)
+    if journal and journal['header']['user_id'] == session['user_id'] and not journal['finished']:
+        if import_journal_running(job_id):
+            return jsonify({
+                'error': 'Job import đang chạy ở tiến trình khác',
+                'running': True,
+                'job_id': job_id
+            }), 409
+        return jsonify({
+            'error': 'Job import bị gián đoạn. Chọn lại đúng file đã import và bấm "Tiếp tục import"',
+            'resumable': True,
+            'job_id': job_id,
+            'ministry_ids': journal['header']['ministry_ids'],
+            'done_cells': sum(1 for entry in journal['cells'].values() if entry['status'] in ('success', 'skipped'))
+        }), 404
+    return jsonify({'error': 'Không tìm thấy job import'}), 404
+
+@app.route('/import-jobs/<job_id>')
+@login_required
+def get_import_job(job_id):
+    """Tiến độ và kết quả của một job import"""
+    job = import_jobs.get(job_id)
 
-                ministry_result['status'] = 'success' if create_result['success'] else 'error'
-                ministry_result['message'] = create_result['message']
-                if 'details' in create_result:
-                    ministry_result['details'] = create_result['details']
+    if not job or job['user_id'] != session['user_id']:
+        return import_job_not_found(job_id)
 
-                result['ministries'].append(ministry_result)
+    try:
+        since = max(0, int(request.args.get('since', 0)))
+    except ValueError:
+        since = 0
 
-            results.append(result)
+    return jsonify(serialize_import_job(job, since))
 
-        # Thống kê kết quả
-        total_accounts = len(results)
-        total_operations = total_accounts * len(selected_ministry_ids)
-        success_count = sum(
-            1 for r in results
-            for m in r['ministries']
-            if m['status'] == 'success'
-        )
-        error_count = sum(
-            1 for r in results
-            for m in r['ministries']
-            if m['status'] in ['error', 'no_token', 'token_expired']
-        )
+@app.route('/import-jobs/<job_id>/retry-experience', methods=['POST'])
+@login_required
+def retry_import_experience(job_id):
+    """Cập nhật lại quá trình công tác cho các ô bị lỗi experience của job đã xong, không tạo lại tài khoản"""
+    job = import_jobs.get(job_id)
+
+    if not job or job['user_id'] != session['user_id']:
+        return import_job_not_found(job_id)
+
+    with import_jobs_lock:
+        if job['status'] != 'done':
+            return jsonify({'error': 'Job import đang chạy, chờ job xong rồi thử lại'}), 409
+
+        cells = [(index, position, m['ministry_id'], m)
+                 for index, result in enumerate(job['results'])
+                 for position, m in enumerate(result['ministries'])
+                 if m and m.get('experience_error') and m.get('user_id')]
+        if not cells:
+            return jsonify({'success': True, 'job_id': job['id'], 'retried': 0})
+
+        # Mở lại job: các dòng được thử lại tính là dòng chờ cho tới khi bước experience xong
+        for index in sorted({index for index, _, _, _ in cells}):
+            count_import_row(job['summary'], job['results'][index], -1)
+            job['summary']['pending_rows'] += 1
+        for index, _, _, _ in cells:
+            job['row_pending'][index] += 1
+        job['status'] = 'running'
+        job['reading'] = True
+        job['finished_at'] = None
 
-        return jsonify({
-            'success': True,
-            'results': results,
-            'summary': {
-                'total_accounts': total_accounts,
-                'total_operations': total_operations,
-                'success_count': success_count,
-                'error_count': error_count
-            }
-        })
+    try:
+        job['journal'] = lock_import_journal(job['id'])
+    except OSError as e:
+        job['journal'] = None
+        log.error('Không mở được nhật ký import: %s', e, extra={'job_id': job['id']})
+    write_import_journal(job, {'type': 'retry_experience', 'cells': len(cells)})
 
-    except Exception as e:
-        return jsonify({'error': f'Lỗi khi đọc file Excel: {str(e)}'})
+    def feed():
+        try:
+            for index, position, ministry_id, ministry_result in cells:
+                submit_import_stage('experience', ministry_id, run_experience_cell, job, index, position, ministry_id,
+                                    job['results'][index]['account'], ministry_result)
+        finally:
+            with import_jobs_lock:
+                job['reading'] = False
+                finish_import_job_if_done(job)
+                import_jobs_changed.notify_all()
+
+    threading.Thread(target=contextvars.copy_context().run, args=(feed,), daemon=True,
+                     name=f"import-retry-{job['id'][:8]}").start()
+
+    return jsonify({'success': True, 'job_id': job['id'], 'retried': len(cells)})
+
+@app.route('/import-jobs/<job_id>/stream')
+@login_required
+def stream_import_job(job_id):
+    """Stream NDJSON kết quả từng dòng của job import ngay khi dòng đó xong.
+
+    Mỗi kết nối kéo dài tối đa IMPORT_STREAM_MAX_SECONDS rồi kết thúc bằng dòng 'reconnect';
+    client kết nối lại với since=next.
+    """
+    if not IMPORT_STREAM_ENABLED:
+        return jsonify({'error': 'Stream job import chưa được bật, dùng /import-jobs/<job_id>'}), 404
+
+    job = import_jobs.get(job_id)
+
+    if not job or job['user_id'] != session['user_id']:
+        return import_job_not_found(job_id)
+
+    try:
+        since = max(0, int(request.args.get('since', 0)))
+    except ValueError:
+        since = 0
+
+    def generate():
+        cursor = since
+        closes_at = time.monotonic() + IMPORT_STREAM_MAX_SECONDS
+        yield ndjson_line({'type': 'start', 'job_id': job['id'], 'status': job['status']})
+        while True:
+            with import_jobs_changed:
+                import_jobs_changed.wait_for(
+                    lambda: len(job['changes']) > cursor or job['status'] == 'done',
+                    timeout=max(0, min(IMPORT_STREAM_HEARTBEAT, closes_at - time.monotonic()))
+                )
+                rows = [public_import_result(job['results'][index]) for index in changed_import_rows(job, cursor)]
+                cursor = len(job['changes'])
+                summary = dict(job['summary'])
+                status = job['status']
+                error = job['error']
+
+            for row in rows:
+                yield ndjson_line({'type': 'row', 'result': row})
+            # Dòng progress cũng đóng vai trò heartbeat khi chưa có dòng mới
+            yield ndjson_line({'type': 'progress', 'status': status, 'summary': summary, 'error': error, 'next': cursor})
+
+            if status == 'done':
+                yield ndjson_line({'type': 'done', 'summary': summary, 'error': error, 'next': cursor})
+                return
+            if time.monotonic() >= closes_at:
+                yield ndjson_line({'type': 'reconnect', 'next': cursor})
+                return
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'X-Accel-Buffering': 'no', 'Cache-Control': 'no-cache'})
 
 if __name__ == '__main__':
     app.run(debug=False, host='0.0.0.0', port=5000)
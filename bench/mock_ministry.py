@@ -0,0 +1,164 @@
+"""Server giả lập API của các Bộ, dùng để benchmark mà không gọi vào hệ thống thật.
+
+Giả lập các endpoint mà app.py gọi tới:
+    POST /auth/realms/digo/protocol/openid-connect/token   (Keycloak: password / refresh_token)
+    GET  /hu/user                                         (tra cứu tài khoản, có phân trang)
+    POST /hu/user/--fully                                 (tạo tài khoản)
+    PUT  /hu/user/<id>/experience                         (cập nhật quá trình công tác)
+    GET  /ba/agency/tree-view                             (tra cứu / tải cây agency)
+
+Mọi Bộ dùng chung một server; Bộ được phân biệt bằng header X-Mock-Host (host gốc của request,
+do adapter của bench/run_benchmark.py gắn vào). Độ trễ, tỉ lệ lỗi và giới hạn tốc độ cấu hình được:
+
+    python bench/mock_ministry.py --port 8765 --latency 0.05 --jitter 0.05 --error-rate 0.01 --rate-limit 50
+"""
+import argparse
+import random
+import threading
+import time
+import uuid
+
+from flask import Flask, jsonify, request
+
+
+class MockState:
+    """Dữ liệu và thống kê của server giả lập (an toàn giữa các thread)"""
+
+    def __init__(self, latency=0.05, jitter=0.05, error_rate=0.0, rate_limit=0, token_ttl=300):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit  # request/giây cho mỗi host, 0 = không giới hạn
+        self.token_ttl = token_ttl
+        self.users = {}  # {host: {username: user}}
+        self.buckets = {}  # {host: [tokens, updated_at]}
+        self.stats = {'requests': 0, 'errors': 0, 'throttled': 0}
+        self.lock = threading.Lock()
+
+    def throttle(self, host):
+        """True nếu host đã vượt giới hạn tốc độ (token bucket, dồn tối đa 1 giây)"""
+        if self.rate_limit <= 0:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            tokens, updated_at = self.buckets.get(host, (self.rate_limit, now))
+            tokens = min(self.rate_limit, tokens + (now - updated_at) * self.rate_limit)
+            throttled = tokens < 1
+            self.buckets[host] = [tokens if throttled else tokens - 1, now]
+            return throttled
+
+
+def create_mock_app(state):
+    """Tạo Flask app giả lập các Bộ theo cấu hình trong `state`"""
+    app = Flask(__name__)
+
+    @app.before_request
+    def simulate_network():
+        host = request.headers.get('X-Mock-Host', request.host)
+        with state.lock:
+            state.stats['requests'] += 1
+
+        if state.throttle(host):
+            with state.lock:
+                state.stats['throttled'] += 1
+            return jsonify({'message': 'Too Many Requests'}), 429, {'Retry-After': '1'}
+
+        time.sleep(max(0, state.latency + random.uniform(-state.jitter, state.jitter)))
+
+        if state.error_rate and random.random() < state.error_rate:
+            with state.lock:
+                state.stats['errors'] += 1
+            return jsonify({'message': 'Service Unavailable'}), 503
+
+    def users_of_host():
+        host = request.headers.get('X-Mock-Host', request.host)
+        with state.lock:
+            return state.users.setdefault(host, {})
+
+    @app.route('/auth/realms/digo/protocol/openid-connect/token', methods=['POST'])
+    def token():
+        if request.form.get('grant_type') not in ('password', 'refresh_token'):
+            return jsonify({'error': 'unsupported_grant_type'}), 400
+        return jsonify({
+            'access_token': uuid.uuid4().hex,
+            'refresh_token': uuid.uuid4().hex,
+            'expires_in': state.token_ttl,
+            'refresh_expires_in': state.token_ttl * 6,
+            'token_type': 'Bearer'
+        })
+
+    @app.route('/hu/user', methods=['GET'])
+    def search_users():
+        keyword = request.args.get('keyword', '').casefold()
+        page = int(request.args.get('page', 0))
+        size = int(request.args.get('size', 10))
+        users = users_of_host()
+        with state.lock:
+            matched = [user for username, user in users.items() if keyword in username.casefold()]
+        total_pages = (len(matched) + size - 1) // size
+        return jsonify({
+            'content': matched[page * size:(page + 1) * size],
+            'totalPages': total_pages,
+            'totalElements': len(matched)
+        })
+
+    @app.route('/hu/user/--fully', methods=['POST'])
+    def create_user():
+        data = request.get_json(silent=True) or {}
+        usernames = (data.get('account') or {}).get('username') or [{}]
+        username = usernames[0].get('value')
+        if not username:
+            return jsonify({'message': 'username is required'}), 400
+
+        users = users_of_host()
+        with state.lock:
+            if username in users:
+                return jsonify({'message': 'Username already exists'}), 409
+            user = {'id': uuid.uuid4().hex, 'fullname': data.get('fullname'), 'account': {'username': [{'value': username}]}}
+            users[username] = user
+        return jsonify(user), 201
+
+    @app.route('/hu/user/<user_id>/experience', methods=['PUT'])
+    def update_experience(user_id):
+        return jsonify(request.get_json(silent=True) or [])
+
+    @app.route('/ba/agency/tree-view', methods=['GET'])
+    def agency_tree():
+        keyword = request.args.get('keyword', '')
+        # Tải cả cây (không keyword) trả về một trang rỗng; có keyword thì luôn tìm thấy một agency
+        if not keyword:
+            return jsonify({'content': [], 'totalPages': 1})
+        return jsonify({'content': [{'id': uuid.uuid5(uuid.NAMESPACE_DNS, keyword).hex, 'name': keyword}], 'totalPages': 1})
+
+    @app.route('/mock/stats')
+    def mock_stats():
+        with state.lock:
+            return jsonify({**state.stats, 'users': sum(len(users) for users in state.users.values())})
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Server giả lập API các Bộ')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.05, help='Độ trễ trung bình mỗi request (giây)')
+    parser.add_argument('--jitter', type=float, default=0.05, help='Độ lệch ngẫu nhiên của độ trễ (giây)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Tỉ lệ request trả về 503')
+    parser.add_argument('--rate-limit', type=float, default=0, help='Số request/giây tối đa mỗi Bộ, vượt thì trả 429')
+    args = parser.parse_args()
+
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    state = MockState(args.latency, args.jitter, args.error_rate, args.rate_limit)
+    server = make_server(args.host, args.port, create_mock_app(state), threaded=True, request_handler=QuietRequestHandler)
+    print(f'Mock ministry server: http://{args.host}:{server.server_port}', flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
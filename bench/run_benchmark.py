@@ -0,0 +1,290 @@
+"""Benchmark end-to-end: đồng bộ token, tra cứu và import tài khoản trên server giả lập các Bộ.
+
+Mỗi kịch bản (số dòng x số Bộ) chạy trong một process riêng để đo bộ nhớ đỉnh (ru_maxrss) độc lập.
+Mọi request của app.py được chuyển tới bench/mock_ministry.py bằng adapter gắn vào http_sessions
+(và transport của AsyncBackend khi bật ASYNC_BACKEND), nên connection pool, retry, rate limiter
+và circuit breaker của app vẫn được dùng như thật.
+
+    python bench/run_benchmark.py                                  # 100, 1000, 10000 dòng x 1, 7 Bộ
+    python bench/run_benchmark.py --rows 100,1000 --ministries 1,3,7 --latency 0.02 --error-rate 0.01
+    python bench/run_benchmark.py --output bench.json              # lưu kết quả
+    python bench/run_benchmark.py --compare bench.json             # so sánh, exit 1 nếu chậm đi
+    ASYNC_BACKEND=1 python bench/run_benchmark.py                  # gọi các Bộ qua event loop (httpx)
+
+Rate limiter của app mặc định tắt khi benchmark (MINISTRY_RATE_LIMIT=0) và chỉ ghi log từ mức WARNING
+(LOG_LEVEL=WARNING); đặt các biến môi trường này để đo với cấu hình thật.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def latency_summary(values):
+    """p50/p95/p99 (mili giây) của danh sách độ trễ (giây)"""
+    return {
+        'count': len(values),
+        **{f'p{int(q * 100)}': round(percentile(values, q) * 1000, 1) if values else None for q in (0.5, 0.95, 0.99)}
+    }
+
+
+def endpoint_of(method, path):
+    """Tên endpoint của request tới Bộ, dùng để gom thống kê độ trễ"""
+    if path.endswith('/openid-connect/token'):
+        return 'token'
+    if path.endswith('/--fully'):
+        return 'create'
+    if path.endswith('/experience'):
+        return 'experience'
+    if path.endswith('/tree-view'):
+        return 'agency'
+    if path.endswith('/hu/user'):
+        return 'lookup'
+    return f'{method} {path}'
+
+
+def install_mock_adapter(app_module, mock_url):
+    """Chuyển mọi request tới các Bộ sang server giả lập; trả về dict ghi độ trễ theo endpoint"""
+    from requests.adapters import HTTPAdapter
+
+    mock = urlsplit(mock_url)
+    latencies = {}
+    lock = threading.Lock()
+
+    class MockRedirectAdapter(HTTPAdapter):
+        def send(self, request, **kwargs):
+            url = urlsplit(request.url)
+            request.headers['X-Mock-Host'] = url.netloc
+            request.url = urlunsplit((mock.scheme, mock.netloc, url.path, url.query, ''))
+            started = time.monotonic()
+            try:
+                return super().send(request, **kwargs)
+            finally:
+                with lock:
+                    latencies.setdefault(endpoint_of(request.method, url.path), []).append(time.monotonic() - started)
+
+    for ministry in app_module.ministries:
+        http_session = app_module.get_http_session(ministry)
+        # Giữ cấu hình retry / pool của app
+        adapter = MockRedirectAdapter(pool_maxsize=app_module.HTTP_POOL_MAXSIZE,
+                                      max_retries=http_session.get_adapter('https://').max_retries)
+        http_session.mount('https://', adapter)
+        http_session.mount('http://', adapter)
+
+    backend = app_module.get_async_backend()
+    if backend:
+        class MockRedirectTransport(backend.transport_class):
+            async def handle_async_request(self, request):
+                url = request.url
+                request.headers['X-Mock-Host'] = url.netloc.decode()
+                request.url = url.copy_with(scheme=mock.scheme, netloc=mock.netloc.encode())
+                started = time.monotonic()
+                try:
+                    return await super().handle_async_request(request)
+                finally:
+                    with lock:
+                        latencies.setdefault(endpoint_of(request.method, url.path), []).append(time.monotonic() - started)
+
+        backend.transport_class = MockRedirectTransport
+
+    return latencies
+
+
+def build_csv(rows, prefix):
+    """File CSV import gồm `rows` dòng, username duy nhất theo `prefix`"""
+    output = io.StringIO()
+    output.write('fullname,phoneNumber,email,username,password,agencyParent,agencyDepartment,position\n')
+    for i in range(rows):
+        output.write(f'Nguyen Van {i},09{i:08d},{prefix}{i}@example.com,{prefix}{i},Secret@123,'
+                     f'Don vi {i % 20},Phong {i % 50},Chuyên viên\n')
+    return output.getvalue().encode('utf-8')
+
+
+def run_scenario(args):
+    """Chạy một kịch bản trong process hiện tại, trả về dict kết quả"""
+    sys.path.insert(0, ROOT_DIR)
+    import app as app_module
+
+    latencies = install_mock_adapter(app_module, args.mock_url)
+    ministry_ids = [m['id'] for m in app_module.ministries[:args.ministry_count]]
+    prefix = f'bench{os.getpid()}x'
+
+    client = app_module.app.test_client()
+    with client.session_transaction() as flask_session:
+        flask_session['user_id'] = 'bench'
+        flask_session['ministry_username'] = 'bench'
+        flask_session['ministry_password'] = 'bench'
+
+    result = {'rows': args.rows, 'ministries': args.ministry_count}
+    # stdout của process con chỉ dùng để trả kết quả JSON
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        # Đồng bộ token trên tất cả các Bộ
+        started = time.monotonic()
+        synced = client.post('/sync-tokens').get_json()['results']
+        result['sync_tokens'] = {
+            'seconds': round(time.monotonic() - started, 3),
+            'success': sum(1 for r in synced if r['status'] == 'success')
+        }
+
+        # Import
+        latencies.clear()
+        started = time.monotonic()
+        response = client.post('/import-accounts', data={
+            'file': (io.BytesIO(build_csv(args.rows, prefix)), 'bench.csv'),
+            'ministries': ','.join(str(i) for i in ministry_ids)
+        }).get_json()
+        job_id = response['job_id']
+        while True:
+            job = client.get(f'/import-jobs/{job_id}?since=999999999').get_json()
+            if job['status'] == 'done':
+                break
+            time.sleep(0.1)
+        seconds = time.monotonic() - started
+        import_latencies = [v for endpoint in ('create', 'experience', 'agency') for v in latencies.get(endpoint, [])]
+        result['import'] = {
+            'seconds': round(seconds, 3),
+            'rows_per_sec': round(args.rows / seconds, 2),
+            'cells_per_sec': round(args.rows * len(ministry_ids) / seconds, 2),
+            'success_count': job['summary']['success_count'],
+            'error_count': job['summary']['error_count'],
+            'http': latency_summary(import_latencies),
+            'endpoints': {endpoint: latency_summary(values) for endpoint, values in latencies.items()}
+        }
+
+        # Tra cứu tài khoản vừa tạo (wait=all) trên tất cả các Bộ
+        lookup_latencies = []
+        for i in range(args.lookups):
+            started = time.monotonic()
+            client.post('/lookup-account', data={'keyword': f'{prefix}{i % args.rows}', 'wait': 'all'})
+            lookup_latencies.append(time.monotonic() - started)
+        result['lookup'] = latency_summary(lookup_latencies)
+
+    # ru_maxrss trên Linux tính bằng KB
+    result['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return result
+
+
+def start_mock_server(args):
+    """Chạy server giả lập trong process riêng, trả về (process, url)"""
+    process = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, 'mock_ministry.py'), '--port', '0',
+        '--latency', str(args.latency), '--jitter', str(args.jitter),
+        '--error-rate', str(args.error_rate), '--rate-limit', str(args.mock_rate_limit)
+    ], stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line.startswith('Mock ministry server:'):
+        process.kill()
+        raise RuntimeError('Không khởi động được server giả lập')
+    return process, line.split(': ', 1)[1].strip()
+
+
+def compare_results(results, baseline_path, threshold):
+    """In so sánh rows/sec với kết quả cũ; trả về True nếu có kịch bản chậm đi quá ngưỡng"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {(r['rows'], r['ministries']): r for r in json.load(f)['results']}
+
+    regressed = False
+    for result in results:
+        old = baseline.get((result['rows'], result['ministries']))
+        if not old:
+            continue
+        change = result['import']['rows_per_sec'] / old['import']['rows_per_sec'] - 1
+        flag = 'REGRESSION' if change < -threshold else ''
+        regressed = regressed or bool(flag)
+        print(f"{result['rows']:>6} dòng x {result['ministries']} Bộ: {old['import']['rows_per_sec']:>8.2f} -> "
+              f"{result['import']['rows_per_sec']:>8.2f} rows/s ({change:+.1%}) {flag}")
+    return regressed
+
+
+def print_table(results):
+    print(f"{'rows':>6} {'bộ':>3} {'rows/s':>9} {'cells/s':>9} {'lỗi':>5} {'http p50':>9} {'p95':>8} {'p99':>8} "
+          f"{'lookup p50':>11} {'p99':>8} {'sync s':>7} {'RSS MB':>7}")
+    for r in results:
+        http, lookup = r['import']['http'], r['lookup']
+        print(f"{r['rows']:>6} {r['ministries']:>3} {r['import']['rows_per_sec']:>9.2f} {r['import']['cells_per_sec']:>9.2f} "
+              f"{r['import']['error_count']:>5} {http['p50'] or 0:>9.1f} {http['p95'] or 0:>8.1f} {http['p99'] or 0:>8.1f} "
+              f"{lookup['p50'] or 0:>11.1f} {lookup['p99'] or 0:>8.1f} {r['sync_tokens']['seconds']:>7.2f} {r['peak_rss_mb']:>7.1f}")
+    print('(độ trễ tính bằng ms)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark import / tra cứu / đồng bộ token trên server giả lập')
+    parser.add_argument('--rows', default='100,1000,10000', help='Danh sách số dòng import, phân cách bằng dấu phẩy')
+    parser.add_argument('--ministries', default='1,7', help='Danh sách số Bộ (1-7), phân cách bằng dấu phẩy')
+    parser.add_argument('--lookups', type=int, default=20, help='Số lần tra cứu mỗi kịch bản')
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--mock-rate-limit', type=float, default=0, help='Giới hạn request/giây mỗi Bộ của server giả lập')
+    parser.add_argument('--mock-url', help='Dùng server giả lập đang chạy thay vì tự khởi động')
+    parser.add_argument('--output', help='Ghi kết quả ra file JSON')
+    parser.add_argument('--compare', help='File JSON kết quả cũ để so sánh rows/sec')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Mức giảm rows/sec bị coi là chậm đi (mặc định 10%%)')
+    # Dùng nội bộ: chạy một kịch bản trong process con
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--ministry-count', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        args.rows = int(args.rows)
+        print(json.dumps(run_scenario(args)))
+        return
+
+    mock_process = None
+    if not args.mock_url:
+        mock_process, args.mock_url = start_mock_server(args)
+
+    env = dict(os.environ)
+    env.setdefault('MINISTRY_RATE_LIMIT', '0')
+    env.setdefault('LOG_LEVEL', 'WARNING')
+    # Nhật ký import của các lần chạy thử ghi vào thư mục tạm, xóa khi kết thúc
+    journal_dir = tempfile.TemporaryDirectory(prefix='bench-journal-')
+    env.setdefault('IMPORT_JOURNAL_DIR', journal_dir.name)
+
+    results = []
+    try:
+        for rows in [int(x) for x in args.rows.split(',')]:
+            for ministry_count in [int(x) for x in args.ministries.split(',')]:
+                print(f'Đang chạy: {rows} dòng x {ministry_count} Bộ...', file=sys.stderr, flush=True)
+                output = subprocess.run([
+                    sys.executable, os.path.abspath(__file__), '--child', '--rows', str(rows),
+                    '--ministry-count', str(ministry_count), '--lookups', str(args.lookups), '--mock-url', args.mock_url
+                ], env=env, cwd=ROOT_DIR, stdout=subprocess.PIPE, text=True, check=True).stdout
+                results.append(json.loads(output.strip().splitlines()[-1]))
+    finally:
+        if mock_process:
+            mock_process.terminate()
+            mock_process.wait()
+        journal_dir.cleanup()
+
+    print_table(results)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'config': {k: v for k, v in vars(args).items() if k not in ('child', 'ministry_count')},
+                       'results': results}, f, ensure_ascii=False, indent=2)
+
+    if args.compare and compare_results(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()